@@ -0,0 +1,145 @@
+#
+# Framed protocol, see ../prettierd.mjs
+#
+import asyncio, threading, json, time
+from .rpc import HEADER, encode_frame, make_request
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """Receives every frame straight into one preallocated buffer of its exact size,
+    and resolves the pending future of the request with the same "id".
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+        self.header = bytearray(HEADER.size)
+        self.buffer = self.header
+        self.pos = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return memoryview(self.buffer)[self.pos:]
+
+    def buffer_updated(self, nbytes):
+        self.pos += nbytes
+        if self.pos < len(self.buffer): return
+        self.pos = 0
+        if self.buffer is self.header:
+            size, = HEADER.unpack(self.header)
+            self.buffer = bytearray(size)
+        else:
+            buffer, self.buffer = self.buffer, self.header
+            response = json.loads(buffer)
+            future = self.pending.get(response.get("id"))
+            if future and not future.done():
+                future.set_result(response)
+
+    def connection_lost(self, exc):
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(exc or "connection closed"))
+
+
+class Client:
+    """A long-lived connection to the daemon, served by an event loop on a background thread.
+
+    request() can be called from any thread, it returns a concurrent.futures.Future
+    of the response, so many requests can be in flight at the same time.
+    A request not answered in `timeout` seconds is cancelled and fails with TimeoutError.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.timeout = None
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.ready = False
+        self.respawning = False
+        self.loop = asyncio.new_event_loop()
+        self.protocol = None
+        self.connecting = None
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    # request("getFileInfo", { "path": "a.js" }) => Future({ "id": 1, "ok": { ... } }), future.seq == 1
+    def request(self, method, params=None, timeout=None):
+        timeout = timeout or self.timeout
+        deadline = int((time.time() + timeout) * 1000) if timeout else None
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+        request = make_request(method, params, seq=seq, deadline=deadline)
+        future = asyncio.run_coroutine_threadsafe(self._request(request, timeout), self.loop)
+        future.seq = seq
+        return future
+
+    def call(self, method, params=None, timeout=None):
+        return self.request(method, params, timeout).result()
+
+    # cancel(future.seq) tells the daemon to drop that request, its response will be "Cancelled"
+    def cancel(self, seq):
+        self.request("cancel", { "seq": seq })
+
+    # begin_respawn() => True if the caller should respawn the daemon, False if someone else is doing it
+    def begin_respawn(self):
+        with self.lock:
+            if self.respawning: return False
+            self.respawning = True
+            self.ready = False
+            return True
+
+    def end_respawn(self):
+        with self.lock:
+            self.respawning = False
+
+    def set_ready(self, ready):
+        with self.lock:
+            self.ready = ready
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self._close)
+
+    def stop(self):
+        self.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _request(self, request, timeout=None):
+        protocol = await self._connect()
+        future = self.loop.create_future()
+        protocol.pending[request["seq"]] = future
+        try:
+            protocol.transport.write(encode_frame(request))
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            if not protocol.transport.is_closing():
+                protocol.transport.write(encode_frame(make_request("cancel", { "seq": request["seq"] })))
+            raise TimeoutError(f"{request['method']} timed out after {timeout}s")
+        finally:
+            protocol.pending.pop(request["seq"], None)
+
+    async def _connect(self):
+        if self.protocol is not None and not self.protocol.transport.is_closing():
+            return self.protocol
+        if self.connecting is None:
+            self.connecting = self.loop.create_task(self._open())
+        try:
+            return await asyncio.shield(self.connecting)
+        finally:
+            self.connecting = None
+
+    async def _open(self):
+        if isinstance(self.server, str):
+            _, protocol = await self.loop.create_unix_connection(FrameProtocol, self.server)
+        else:
+            _, protocol = await self.loop.create_connection(FrameProtocol, *self.server)
+        self.protocol = protocol
+        return protocol
+
+    def _close(self):
+        if self.protocol is not None:
+            self.protocol.transport.close()
+            self.protocol = None
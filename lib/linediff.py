@@ -0,0 +1,308 @@
+#
+# Line-level diff of formatter output, see diff() below.
+#
+# Prettier mostly rewrites whole lines, so the texts are compared as sequences of
+# interned line ids first, and only the changed hunks are compared by characters.
+#
+from array import array
+from itertools import accumulate
+
+EQUAL, DELETE, INSERT = 0, -1, 1
+
+MAX_LINE_EDITS = 300    # beyond it, split the lines by unique ones (patience) and retry
+MAX_CHAR_EDITS = 200    # beyond it, a hunk is replaced as a whole
+MAX_REFINE = 20000      # hunks with more characters are replaced as a whole
+STEP_EDITS = 64         # without lines to split by, myers() is run this many edits at a time
+MAX_WEAK = 16           # unchanged lines with fewer characters between two hunks are refined with them
+
+
+# common_prefix("abc", "abd") => 2, works on str and array, halving the slice compared each step
+def common_prefix(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+# common_suffix("abc", "xbc") => 2
+def common_suffix(a, b):
+    n, m = len(a), len(b)
+    lo, hi = 0, min(n, m)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[n - mid:n - lo] == b[m - mid:m - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+# myers("abc", "abd", 10) => [(0, 0, 2)], the common runs (i, j, length) of a shortest edit script,
+# or None if it takes more than max_d deletions and insertions.
+def myers(a, b, max_d):
+    blocks, x, y = furthest(a, b, max_d)
+    return blocks if (x, y) == (len(a), len(b)) else None
+
+
+# furthest("abc", "xbc", 1) => ([], 1, 0), the common runs up to the furthest point (x, y) reachable
+# with max_d deletions and insertions, which is (len(a), len(b)) if they are enough.
+def furthest(a, b, max_d):
+    n, m = len(a), len(b)
+    max_d = min(max_d, n + m)
+    off = max_d + 1
+    v = [0] * (2 * off + 1)
+    trace = []
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[off + k - 1] < v[off + k + 1]):
+                x = v[off + k + 1]
+            else:
+                x = v[off + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[off + k] = x
+            if x >= n and y >= m:
+                trace.append(v[off - d:off + d + 1])
+                return backtrack(trace, n, m), n, m
+        trace.append(v[off - d:off + d + 1])
+    # not enough, stop at the point on the grid which went the furthest
+    reached = [(2 * v[off + k] - k, k) for k in range(-max_d, max_d + 1, 2) if v[off + k] <= n and 0 <= v[off + k] - k <= m]
+    if not reached: return [], 0, 0
+    _, k = max(reached)
+    x = v[off + k]
+    return backtrack(trace, x, x - k), x, x - k
+
+
+# Walks the trace of furthest() back from (x, y), trace[d][k + d] is the furthest x on diagonal k.
+def backtrack(trace, x, y):
+    blocks = []
+    for d in range(len(trace) - 1, 0, -1):
+        prev, k = trace[d - 1], x - y
+        if k == -d or (k != d and prev[k - 1 + d - 1] < prev[k + 1 + d - 1]):
+            k0 = k + 1
+            x0 = prev[k0 + d - 1]
+            x1, y1 = x0, x0 - k
+        else:
+            k0 = k - 1
+            x0 = prev[k0 + d - 1]
+            x1, y1 = x0 + 1, x0 + 1 - k
+        if x > x1: blocks.append((x1, y1, x - x1))
+        x, y = x0, x0 - k0
+    if x > 0: blocks.append((0, 0, x))
+    blocks.reverse()
+    return blocks
+
+
+# patience([1, 2, 3], [3, 2, 4]) => [(2, 0, 1)], matches lines unique to both sides in the
+# longest increasing order, then diffs the gaps between them. Without unique lines,
+# the least repeated lines that appear as many times on both sides are matched in order.
+def patience(a, b):
+    count_a, count_b = {}, {}
+    for x in a: count_a[x] = count_a.get(x, 0) + 1
+    for x in b: count_b[x] = count_b.get(x, 0) + 1
+    counts = [n for x, n in count_a.items() if count_b.get(x) == n]
+    if not counts: return steps(a, b)
+    rarest = min(counts)
+    where = {}
+    for j, x in enumerate(b):
+        if count_b[x] == rarest and count_a.get(x) == rarest: where.setdefault(x, []).append(j)
+    pairs, seen = [], {}
+    for i, x in enumerate(a):
+        if x in where:
+            k = seen[x] = seen.get(x, -1) + 1
+            pairs.append((i, where[x][k]))
+    # longest increasing subsequence of j by patience sorting
+    tails, links = [], {}
+    for i, j in pairs:
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tails[mid][1] < j:
+                lo = mid + 1
+            else:
+                hi = mid
+        links[i, j] = tails[lo - 1] if lo else None
+        if lo == len(tails):
+            tails.append((i, j))
+        else:
+            tails[lo] = (i, j)
+    anchors, pair = [], tails[-1]
+    while pair:
+        anchors.append(pair)
+        pair = links[pair]
+    anchors.reverse()
+    blocks, i0, j0 = [], 0, 0
+    for i, j in anchors + [(len(a), len(b))]:
+        blocks.extend((x + i0, y + j0, n) for x, y, n in matching(a[i0:i], b[j0:j]))
+        if i < len(a): blocks.append((i, j, 1))
+        i0, j0 = i + 1, j + 1
+    return blocks
+
+
+# steps([1, 2], [2, 1]) => [(1, 0, 1)], like myers() but STEP_EDITS at a time from the furthest point,
+# for sequences too different to diff at once, in time linear to their lengths.
+def steps(a, b):
+    blocks, i, j = [], 0, 0
+    while i < len(a) and j < len(b):
+        part, x, y = furthest(a[i:], b[j:], STEP_EDITS)
+        if x == y == 0: break
+        blocks.extend((x0 + i, y0 + j, n) for x0, y0, n in part)
+        i, j = i + x, j + y
+    return blocks
+
+
+# matching([1, 2, 3], [1, 3]) => [(0, 0, 1), (2, 1, 1)], the common runs of two sequences of line ids
+def matching(a, b):
+    p = common_prefix(a, b)
+    s = common_suffix(a[p:], b[p:])
+    a1, b1 = a[p:len(a) - s], b[p:len(b) - s]
+    inner = myers(a1, b1, MAX_LINE_EDITS) if a1 and b1 else []
+    if inner is None: inner = patience(a1, b1)
+    blocks = [(0, 0, p)] if p else []
+    blocks.extend((i + p, j + p, n) for i, j, n in inner)
+    if s: blocks.append((len(a) - s, len(b) - s, s))
+    return blocks
+
+
+# refine(diff, 0, 5, 0, 5) adds the diff of old[0:5] and new[0:5] by characters,
+# as in refine("a = 1", "a = 2") => [(0, "a = "), (-1, "1"), (1, "2")]
+def refine(diff, a0, a1, b0, b1):
+    a, b = diff.old[a0:a1], diff.new[b0:b1]
+    p = common_prefix(a, b)
+    s = common_suffix(a[p:], b[p:])
+    n1, n2 = len(a) - s - p, len(b) - s - p
+    blocks = None
+    if n1 and n2 and n1 + n2 <= MAX_REFINE:
+        blocks = myers(a[p:p + n1], b[p:p + n2], MAX_CHAR_EDITS)
+    diff.add(EQUAL, p)
+    i = j = 0
+    for x, y, n in (blocks or []) + [(n1, n2, 0)]:
+        diff.add(DELETE, x - i)
+        diff.add(INSERT, y - j)
+        diff.add(EQUAL, n)
+        i, j = x + n, y + n
+    diff.add(EQUAL, s)
+
+
+class Diff:
+    """The changes turning `old` into `new`, as spans of the texts instead of copies of them.
+
+    ops[k] is EQUAL, DELETE or INSERT of lengths[k] characters at old_at[k] in `old`,
+    which are at new_at[k] in `new`. Iterating it gives the edits [offset, delete_length,
+    insert_text] against `old`, reversed(diff) gives them in the order to apply them.
+    """
+
+    __slots__ = ('old', 'new', 'ops', 'old_at', 'new_at', 'lengths')
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        self.ops = array('b')
+        self.old_at = array('q')
+        self.new_at = array('q')
+        self.lengths = array('q')
+
+    # add(DELETE, 3) appends 3 characters of the op after the last one, merging with it if the same
+    def add(self, op, length):
+        if not length: return
+        i = j = 0
+        if self.ops:
+            last, i, j, n = self.ops[-1], self.old_at[-1], self.new_at[-1], self.lengths[-1]
+            if last == op:
+                self.lengths[-1] += length
+                return
+            if last != INSERT: i += n
+            if last != DELETE: j += n
+        self.ops.append(op)
+        self.old_at.append(i)
+        self.new_at.append(j)
+        self.lengths.append(length)
+
+    def __bool__(self):
+        return any(self.ops)
+
+    def __iter__(self):
+        ops, old_at, new_at, lengths = self.ops, self.old_at, self.new_at, self.lengths
+        k = 0
+        while k < len(ops):
+            if ops[k] == DELETE:
+                if k + 1 < len(ops) and ops[k + 1] == INSERT:
+                    yield [old_at[k], lengths[k], self.new[new_at[k + 1]:new_at[k + 1] + lengths[k + 1]]]
+                    k += 1
+                else:
+                    yield [old_at[k], lengths[k], ""]
+            elif ops[k] == INSERT:
+                yield [old_at[k], 0, self.new[new_at[k]:new_at[k] + lengths[k]]]
+            k += 1
+
+    def __reversed__(self):
+        ops, old_at, new_at, lengths = self.ops, self.old_at, self.new_at, self.lengths
+        k = len(ops) - 1
+        while k >= 0:
+            if ops[k] == INSERT:
+                text = self.new[new_at[k]:new_at[k] + lengths[k]]
+                if k > 0 and ops[k - 1] == DELETE:
+                    k -= 1
+                    yield [old_at[k], lengths[k], text]
+                else:
+                    yield [old_at[k], 0, text]
+            elif ops[k] == DELETE:
+                yield [old_at[k], lengths[k], ""]
+            k -= 1
+
+    # diffs() => [(op, text), ...] like diff_match_patch.diff_main
+    def diffs(self):
+        for op, i, j, n in zip(self.ops, self.old_at, self.new_at, self.lengths):
+            yield (op, self.new[j:j + n] if op == INSERT else self.old[i:i + n])
+
+
+# line_ids("a\nbc", {}) => (array('i', [0, 1]), array('q', [1, 2])), the lines split by "\n" interned
+# in `ids`, and their lengths. The last one has no "\n", so it is interned apart from the same text.
+def line_ids(text, ids):
+    lines = text.split('\n')
+    last = lines[-1]
+    numbers = array('i', [ids.setdefault(line, len(ids)) for line in lines[:-1]])
+    numbers.append(ids.setdefault((last,), len(ids)))
+    return numbers, array('q', map(len, lines))
+
+
+# line_starts([1, 2]) => array('q', [0, 2, 4]), where every line starts and where the last one ends
+def line_starts(lengths):
+    starts = array('q', accumulate(lengths, lambda start, n: start + n + 1, initial=0))
+    starts[-1] -= 1
+    return starts
+
+
+# compact("a  = 1\nb = 2\n", "a = 1\nb = 2\n") => Diff, whose edits are [[2, 1, ""]]
+# Lines are compared by their interned ids, see line_ids().
+def compact(text1, text2):
+    diff = Diff(text1, text2)
+    ids = {}
+    a, lengths1 = line_ids(text1, ids)
+    b, lengths2 = line_ids(text2, ids)
+    starts1, starts2 = line_starts(lengths1), line_starts(lengths2)
+    i = j = 0  # where the current hunk starts
+    x0 = y0 = 0  # where the last unchanged lines end
+    for x, y, n in matching(a, b) + [(len(a), len(b), 0)]:
+        changed = x > x0 or y > y0
+        x0, y0 = x + n, y + n
+        # a "}" or a blank line between two hunks is likely a coincidence, keep it in the hunk
+        if changed and 0 < n and (x0, y0) != (len(a), len(b)) and starts1[x0] - starts1[x] <= MAX_WEAK:
+            continue
+        if x > i or y > j:
+            refine(diff, starts1[i], starts1[x], starts2[j], starts2[y])
+        diff.add(EQUAL, starts1[x0] - starts1[x])
+        i, j = x0, y0
+    return diff
+
+
+# diff("a  = 1\nb = 2\n", "a = 1\nb = 2\n") => [(0, "a "), (-1, " "), (0, "= 1\nb = 2\n")],
+# the same format as diff_match_patch.diff_main, so it can be given to patch_make.
+def diff(text1, text2):
+    return list(compact(text1, text2).diffs())
@@ -0,0 +1,80 @@
+#
+# Framed protocol, see ../prettierd.mjs
+#
+import os, socket, struct, json, mmap, tempfile
+
+HEADER = struct.Struct('>I')
+
+
+# connect(('localhost', 9870)) or connect('/tmp/prettierd-1000.sock') => socket
+def connect(server, timeout=None):
+    if isinstance(server, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(server)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    return socket.create_connection(server, timeout)
+
+
+# make_request("quit") => { "method": "quit" }
+# The daemon gives up a request after its "deadline" (ms since epoch) if there is one.
+def make_request(method, params=None, seq=0, deadline=None):
+    request = { "method": method, "params": params, "seq": seq }
+    if deadline: request["deadline"] = deadline
+    return request
+
+
+# encode_frame({ "method": "ping" }) => b'\x00\x00\x00\x14{"method": "ping"}'
+def encode_frame(message):
+    body = json.dumps(message).encode('utf-8')
+    return HEADER.pack(len(body)) + body
+
+
+# payload_dir() => "/dev/shm", or the temporary folder if there is no shared memory file system
+def payload_dir():
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+# reply_path() => "/dev/shm/prettierd-xxx", an empty file only the user can read, for the daemon to write to
+def reply_path():
+    fd, path = tempfile.mkstemp(prefix='prettierd-', dir=payload_dir())
+    os.close(fd)
+    return path
+
+
+# write_payload("a = 1\n") => { "path": "/dev/shm/prettierd-xxx", "size": 6 }
+# A text too large for a frame is mapped into a file, and only where it is goes through the socket.
+def write_payload(text):
+    data = text.encode('utf-8')
+    fd, path = tempfile.mkstemp(prefix='prettierd-', dir=payload_dir())
+    try:
+        os.ftruncate(fd, len(data))
+        if data:
+            with mmap.mmap(fd, len(data)) as m:
+                m[:] = data
+    finally:
+        os.close(fd)
+    return { "path": path, "size": len(data) }
+
+
+# read_payload({ "path": "/dev/shm/prettierd-xxx", "size": 9 }) => { "ok": 1 }, the JSON the daemon wrote there
+def read_payload(payload):
+    path, size = payload["path"], payload["size"]
+    try:
+        with open(path, 'rb') as f:
+            if not size: return json.loads(f.read())
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as m:
+                return json.loads(m[:size])
+    finally:
+        remove_payload(path)
+
+
+def remove_payload(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
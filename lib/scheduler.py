@@ -0,0 +1,52 @@
+import sublime
+import threading
+
+
+class Scheduler:
+    """Runs at most one job per key at a time, with at most one more queued.
+
+    A job is a function taking a `done` callback which it must call when it
+    finishes. Submitting a job while another one of the same key is running
+    replaces the queued one, so repeated requests coalesce into one run that
+    starts after the current one with whatever state is the latest by then.
+    The queued job runs on the async thread, whichever thread calls `done`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = set()
+        self.queued = {}
+
+    # submit(view.buffer_id(), lambda done: ...) => True if started, False if queued
+    def submit(self, key, job):
+        with self.lock:
+            if key in self.running:
+                self.queued[key] = job
+                return False
+            self.running.add(key)
+        self._run(key, job)
+        return True
+
+    def _run(self, key, job):
+        called = []
+        def done():
+            if called: return
+            called.append(True)
+            self._done(key)
+        try:
+            job(done)
+        except:
+            done()
+            raise
+
+    def _done(self, key):
+        with self.lock:
+            job = self.queued.pop(key, None)
+            if job is None:
+                self.running.discard(key)
+                return
+        sublime.set_timeout_async(lambda: self._run(key, job))
+
+    def forget(self, key):
+        with self.lock:
+            self.queued.pop(key, None)
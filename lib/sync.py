@@ -0,0 +1,80 @@
+import hashlib
+
+MAX_CHANGES = 1000
+
+
+# content_hash("a = 1\n") => "sha1 hex digest of the utf-8 text", the same as the daemon's
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class Document:
+    """Edits made to a buffer since its text was last synced to the daemon.
+
+    Every change is [point, delete_length, insert_text] against the text left
+    by the previous change, recorded together with the change_count after it.
+    """
+
+    def __init__(self):
+        self.hash = None
+        self.change_count = -1
+        self.recorded = -1
+        self.changes = []
+
+    def record(self, changes, change_count):
+        self.recorded = change_count
+        self.changes.extend((change_count, change) for change in changes)
+        if len(self.changes) > MAX_CHANGES:
+            self.reset()
+
+    # params(id, "a = 1\n", "sha1", 3) => { "document": id, "base": "sha1", "changes": [...], "hash": "sha1" }
+    # or => { "document": id, "contents": "a = 1\n" } if there's nothing to build on.
+    def params(self, id, contents, hash, change_count):
+        if self.hash is None or self.recorded != change_count:
+            return { "document": id, "contents": contents }
+        changes = [change for count, change in self.changes if count > self.change_count]
+        return { "document": id, "base": self.hash, "changes": changes, "hash": hash }
+
+    def synced(self, hash, change_count):
+        self.hash = hash
+        self.change_count = change_count
+        self.changes = [(count, change) for count, change in self.changes if count > change_count]
+
+    def reset(self):
+        self.hash = None
+        self.changes = []
+
+
+MAX_RANGES = 100
+
+
+class DirtyRanges:
+    """Regions of a buffer modified since it was last formatted, as [[start, end], ...] in points.
+
+    Every change is [point, delete_length, insert_text] against the text left by the previous one,
+    the regions are moved and merged along with the changes.
+    """
+
+    def __init__(self):
+        self.ranges = []
+
+    def record(self, changes):
+        for point, length, text in changes:
+            self.add(point, point + length, len(text))
+
+    def add(self, a, b, size):
+        delta = size - (b - a)
+        merged = [a, a + size]
+        ranges = []
+        for start, end in self.ranges:
+            if end < a:
+                ranges.append([start, end])
+            elif start > b:
+                ranges.append([start + delta, end + delta])
+            else:
+                merged = [min(merged[0], start), max(merged[1], end + delta)]
+        ranges.append(merged)
+        ranges.sort()
+        if len(ranges) > MAX_RANGES:
+            ranges = [[ranges[0][0], ranges[-1][1]]]
+        self.ranges = ranges
@@ -1,24 +1,35 @@
 import sublime
-import socket, json
+import os, socket, json, tempfile
+from .rpc import connect
 
 # tcp_request(('localhost', 9870), { "method": "quit" }) => "data"
-def tcp_request(server, request):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-        client.connect(server)
+def tcp_request(server, request, timeout=None):
+    with connect(server, timeout) as client:
         client.sendall(bytes(json.dumps(request), "utf-8"))
         client.shutdown(socket.SHUT_WR)
-        data = b""
+        data = bytearray()
         while True:
-            chunk = client.recv(512)
+            chunk = client.recv(65536)
             if chunk:
                 data += chunk
             else:
                 break
         return data.decode('utf-8')
 
-# make_request("quit") => { "method": "quit" }
-def make_request(method, params=None, seq=0):
-    return { "method": method, "params": params, "seq": seq }
+# get_socket_path() => '/run/user/1000/prettierd.sock'
+def get_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, 'prettierd.sock')
+    return os.path.join(tempfile.gettempdir(), f'prettierd-{os.getuid()}.sock')
+
+# standby_address(('localhost', 9870)) => ('localhost', 9871)
+# standby_address('/run/user/1000/prettierd.sock') => '/run/user/1000/prettierd-standby.sock'
+def standby_address(server):
+    if isinstance(server, str):
+        root, ext = os.path.splitext(server)
+        return root + '-standby' + ext
+    return (server[0], server[1] + 1)
 
 # get_file_extension_from_view(view) => '.js'
 def get_file_extension_from_view(view: sublime.View):
@@ -7,13 +7,28 @@
 // So, the prettierd.py controls a subprocess which spawns "node {this_file}".
 //
 // We identify the start is success with an one-line log: {"ok":9870},
-// which means we are listening on port 9870.
+// which means we are listening on port 9870 and prettier is loaded,
+// or {"ok":"/run/user/1000/prettierd.sock"} when using a unix domain socket.
+// It also has the ms each phase of the start took: { time: { import, compile, listen } },
+// "import" for finding prettier, "compile" for loading it and "listen" since the process started.
 // Any other text it read means it failed.
 //
 // Then, we start a simple TCP server to perform request-response based
-// communication. A request is ended with its write stream being shutdown.
+// communication. A connection is in one of the two modes, decided by its first byte:
+//
+// 1. One-shot: the first byte is "{". The request is ended with its write
+//    stream being shutdown, the response is ended with the connection being closed.
+// 2. Framed: every message is a 4-byte big-endian length followed by that many
+//    bytes of JSON. The connection is long-lived and requests can be in flight
+//    at the same time, responses are matched to requests by "id" (or "seq").
+//
+// Multi-megabyte texts can skip the socket: the plugin writes them to a file in
+// shared memory and sends { payload: { path, size } } instead. With "reply" in the
+// params, the result is written to that file and { ok: { payload } } is sent back.
 //
 // Not using stdin-stdout is for multiple request can be handled asynchronously.
+// With WORKERS=n, this file is also the entry of n worker threads which do the
+// CPU heavy part of formatting, so the main thread stays responsive.
 //
 // [Seq-Graph]
 // py: knock knock, is you alive? (tcp.send(9870, { method: "ping" }))
@@ -41,19 +56,86 @@
 // 2. Python is always creating a *detached* subprocess.
 // 3. Python cannot send SIGINT correctly, it can only terminate directly.
 //    To prevent zombie process, we have to send { method: "quit" }.
-import { existsSync, writeFileSync } from 'fs'
+import { constants, existsSync, readFileSync, statSync, unlinkSync, writeFileSync } from 'fs'
+import { mkdir, readFile, readdir, rename, stat, unlink, utimes, writeFile } from 'fs/promises'
 import { spawnSync } from 'child_process'
-import { join } from 'path'
-import { pathToFileURL } from 'url'
-import { createServer } from 'net'
+import { createHash } from 'crypto'
+import module from 'module'
+import { basename, dirname, join, resolve } from 'path'
+import { tmpdir } from 'os'
+import { fileURLToPath, pathToFileURL } from 'url'
+import { connect, createServer } from 'net'
+import { Worker, isMainThread, parentPort } from 'worker_threads'
 
 const exit = process.exit
 
-process.stdin.on('data', e => {
-  if (e.toString().startsWith('q')) exit(2)
-})
+// { import, compile } ms of import_prettier(), see the ready line
+const TIMINGS = {}
+
+// elapsed(start) => ms since `start` (of performance.now()), 0 is the start of the process
+function elapsed(start) {
+  return Math.round(performance.now() - start)
+}
+
+// V8 code of prettier and its parsers is kept in $COMPILE_CACHE_DIR/{node version} (node >= 22.1),
+// so a later start does not compile them again.
+function enable_compile_cache() {
+  const dir = process.env.COMPILE_CACHE_DIR
+  if (dir && module.enableCompileCache) module.enableCompileCache(join(dir, process.version))
+}
+
+if (isMainThread) {
+  process.stdin.on('data', e => {
+    if (e.toString().startsWith('q')) exit(2)
+  })
+}
+
+// { path, version, mtime, node } of the prettier found last time, next to this file
+const PRETTIER_CACHE = join(dirname(fileURLToPath(import.meta.url)), '.prettier-path.json')
+
+// prettier_version('/usr/local/lib/node_modules/prettier/index.mjs') => '3.0.0'
+function prettier_version(prettier_path) {
+  try {
+    return JSON.parse(readFileSync(join(dirname(prettier_path), 'package.json'), 'utf8')).version
+  } catch {
+    return null
+  }
+}
+
+// cached_prettier() => the cached path if the file there is still the same version and mtime,
+// and node is the same one, switching it (nvm, fnm, volta) switches the global node_modules.
+function cached_prettier() {
+  try {
+    let { path, version, mtime, node } = JSON.parse(readFileSync(PRETTIER_CACHE, 'utf8'))
+    if (node !== process.execPath + '@' + process.version) return
+    if (statSync(path).mtimeMs === mtime && prettier_version(path) === version) return path
+  } catch {}
+}
+
+function cache_prettier(path) {
+  try {
+    let node = process.execPath + '@' + process.version
+    let data = { path, version: prettier_version(path), mtime: statSync(path).mtimeMs, node }
+    writeFileSync(PRETTIER_CACHE, JSON.stringify(data))
+  } catch {}
+}
+
+async function import_prettier() {
+  let start = performance.now()
+  let prettier_path = cached_prettier()
+  if (!prettier_path) {
+    prettier_path = find_prettier()
+    cache_prettier(prettier_path)
+  }
+  TIMINGS.import = elapsed(start)
+  start = performance.now()
+  // parsers are plugins loaded by prettier itself on first use, none is loaded here
+  const prettier = await import(pathToFileURL(prettier_path))
+  TIMINGS.compile = elapsed(start)
+  return prettier
+}
 
-function import_prettier() {
+function find_prettier() {
   const win = process.platform === 'win32'
   // npm root -g is slow, test known locations first
   let global_path = win
@@ -75,19 +157,47 @@ function import_prettier() {
       exit(1)
     }
   }
-
-  return import(pathToFileURL(prettier_path))
+  return prettier_path
 }
 
-function create_server(port, handler) {
+function create_server(address, handler, on_listen) {
   let server = createServer({ allowHalfOpen: true }, handler)
-  server.on('error', err => console.error(err.message))
-  server.listen(port, () => console.log('{"ok":%d}', port))
+  server.on('error', err => {
+    if (err.code === 'EADDRINUSE' && typeof address === 'string') {
+      // the socket file may be left by a crashed daemon, take it over if no one answers
+      let probe = connect(address)
+      probe.on('connect', () => {
+        probe.end()
+        console.error(err.message)
+      })
+      probe.on('error', () => {
+        unlinkSync(address)
+        server.listen(address)
+      })
+    } else {
+      console.error(err.message)
+    }
+  })
+  server.listen(address, on_listen)
   return server
 }
 
-function get_port() {
-  return Number(process.env.PORT) || Number.parseInt(process.argv[2]) || 9870
+// 9870 or '/run/user/1000/prettierd.sock'
+function get_address() {
+  let address = process.env.PORT || process.argv[2]
+  return Number.parseInt(address) || address || 9870
+}
+
+function get_workers() {
+  return Number(process.env.WORKERS) || 0
+}
+
+function get_cache_size() {
+  return Number(process.env.CACHE_SIZE) || 0
+}
+
+function get_disk_cache() {
+  return [process.env.CACHE_DIR, Number(process.env.DISK_CACHE_SIZE) || 0]
 }
 
 function get_ppid() {
@@ -112,36 +222,673 @@ async function go(promise) {
   }
 }
 
-const PORT = Symbol('port')
+const MAX_LINE_EDITS = 300 // beyond it, the lines are split by the rarest ones (patience) and diffed again
+const MAX_CHAR_EDITS = 200 // beyond it, a hunk is replaced as a whole
+const MAX_REFINE = 20000 // hunks with more characters are replaced as a whole
+const STEP_EDITS = 64 // without lines to split by, furthest() runs this many edits at a time
+const MAX_WEAK = 16 // unchanged lines with fewer characters between two hunks are refined with them
+
+const is_high_surrogate = code => code >= 0xd800 && code <= 0xdbff
+const is_low_surrogate = code => code >= 0xdc00 && code <= 0xdfff
+
+// common_prefix('abc', 'abd') => 2, never splits a surrogate pair
+function common_prefix(a, b, limit = Math.min(a.length, b.length)) {
+  let i = 0
+  while (i < limit && a.charCodeAt(i) === b.charCodeAt(i)) i++
+  if (i > 0 && is_high_surrogate(a.charCodeAt(i - 1))) i--
+  return i
+}
+
+// common_suffix('xbc', 'ybc') => 2, never splits a surrogate pair
+function common_suffix(a, b, limit = Math.min(a.length, b.length)) {
+  let i = 0
+  while (i < limit && a.charCodeAt(a.length - 1 - i) === b.charCodeAt(b.length - 1 - i)) i++
+  if (i > 0 && is_low_surrogate(a.charCodeAt(a.length - i))) i--
+  return i
+}
+
+// common_head([1, 2, 3], [1, 2, 4]) => 2, common_tail([1, 2, 3], [4, 2, 3]) => 2, of line ids
+function common_head(a, b, limit = Math.min(a.length, b.length)) {
+  let i = 0
+  while (i < limit && a[i] === b[i]) i++
+  return i
+}
+
+function common_tail(a, b, limit = Math.min(a.length, b.length)) {
+  let i = 0
+  while (i < limit && a[a.length - 1 - i] === b[b.length - 1 - i]) i++
+  return i
+}
+
+// myers('abc', 'abd', 10) => [[0, 0, 2]], the common runs [i, j, length] of a shortest edit script,
+// or null if it takes more than `max_d` deletions and insertions. Works on strings and arrays.
+function myers(a, b, max_d) {
+  let [blocks, x, y] = furthest(a, b, max_d)
+  return x === a.length && y === b.length ? blocks : null
+}
+
+// furthest('abc', 'xbc', 1) => [[], 1, 0], the common runs up to the furthest point (x, y) reachable
+// with `max_d` deletions and insertions, which is (a.length, b.length) if they are enough.
+function furthest(a, b, max_d) {
+  let n = a.length, m = b.length
+  max_d = Math.min(max_d, n + m)
+  let off = max_d + 1, v = new Int32Array(2 * off + 1), trace = []
+  for (let d = 0; d <= max_d; d++) {
+    for (let k = -d; k <= d; k += 2) {
+      let x = k === -d || (k !== d && v[off + k - 1] < v[off + k + 1]) ? v[off + k + 1] : v[off + k - 1] + 1
+      let y = x - k
+      while (x < n && y < m && a[x] === b[y]) x++, y++
+      v[off + k] = x
+      if (x >= n && y >= m) {
+        trace.push(v.slice(off - d, off + d + 1))
+        return [backtrack(trace, n, m), n, m]
+      }
+    }
+    trace.push(v.slice(off - d, off + d + 1))
+  }
+  // not enough, stop at the point on the grid which went the furthest
+  let best = -1, x = 0, y = 0
+  for (let k = -max_d; k <= max_d; k += 2) {
+    let x1 = v[off + k], y1 = x1 - k
+    if (x1 <= n && y1 >= 0 && y1 <= m && x1 + y1 >= best) {
+      best = x1 + y1
+      x = x1
+      y = y1
+    }
+  }
+  return best < 0 ? [[], 0, 0] : [backtrack(trace, x, y), x, y]
+}
+
+// Walks the trace of furthest() back from (x, y), trace[d][k + d] is the furthest x on diagonal k.
+function backtrack(trace, x, y) {
+  let blocks = []
+  for (let d = trace.length - 1; d > 0; d--) {
+    let prev = trace[d - 1], k = x - y
+    let down = k === -d || (k !== d && prev[k - 1 + d - 1] < prev[k + 1 + d - 1])
+    let k0 = down ? k + 1 : k - 1
+    let x0 = prev[k0 + d - 1], x1 = down ? x0 : x0 + 1
+    if (x > x1) blocks.push([x1, x1 - k, x - x1])
+    x = x0
+    y = x0 - k0
+  }
+  if (x > 0) blocks.push([0, 0, x])
+  return blocks.reverse()
+}
+
+// patience([1, 2, 3], [3, 2, 4]) => [[2, 0, 1]], matches the lines unique to both sides in the
+// longest increasing order, then diffs the gaps between them. Without unique lines,
+// the least repeated lines that appear as many times on both sides are matched in order.
+function patience(a, b) {
+  let count_a = new Map(), count_b = new Map()
+  for (let x of a) count_a.set(x, (count_a.get(x) ?? 0) + 1)
+  for (let x of b) count_b.set(x, (count_b.get(x) ?? 0) + 1)
+  let rarest = Infinity
+  for (let [x, n] of count_a) if (count_b.get(x) === n && n < rarest) rarest = n
+  if (rarest === Infinity) return steps(a, b)
+  let where = new Map(), seen = new Map(), pairs = []
+  b.forEach((x, j) => {
+    if (count_b.get(x) !== rarest || count_a.get(x) !== rarest) return
+    if (!where.has(x)) where.set(x, [])
+    where.get(x).push(j)
+  })
+  a.forEach((x, i) => {
+    if (!where.has(x)) return
+    let k = seen.get(x) ?? 0
+    seen.set(x, k + 1)
+    pairs.push([i, where.get(x)[k]])
+  })
+  // longest increasing subsequence of j by patience sorting
+  let tails = [], links = new Int32Array(pairs.length)
+  pairs.forEach(([, j], p) => {
+    let lo = 0, hi = tails.length
+    while (lo < hi) {
+      let mid = (lo + hi) >> 1
+      if (pairs[tails[mid]][1] < j) lo = mid + 1
+      else hi = mid
+    }
+    links[p] = lo ? tails[lo - 1] : -1
+    tails[lo] = p
+  })
+  let anchors = [[a.length, b.length]]
+  for (let p = tails[tails.length - 1]; p >= 0; p = links[p]) anchors.push(pairs[p])
+  let blocks = [], i0 = 0, j0 = 0
+  for (let [i, j] of anchors.reverse()) {
+    for (let [x, y, n] of matching(a.slice(i0, i), b.slice(j0, j))) blocks.push([x + i0, y + j0, n])
+    if (i < a.length) blocks.push([i, j, 1])
+    i0 = i + 1
+    j0 = j + 1
+  }
+  return blocks
+}
+
+// steps([1, 2], [2, 1]) => [[1, 0, 1]], like myers() but STEP_EDITS at a time from the furthest point,
+// for sequences too different to diff at once, in time linear to their lengths.
+function steps(a, b) {
+  let blocks = [], i = 0, j = 0
+  while (i < a.length && j < b.length) {
+    let [part, x, y] = furthest(a.slice(i), b.slice(j), STEP_EDITS)
+    if (x === 0 && y === 0) break
+    for (let [x0, y0, n] of part) blocks.push([x0 + i, y0 + j, n])
+    i += x
+    j += y
+  }
+  return blocks
+}
+
+// matching([1, 2, 3], [1, 3]) => [[0, 0, 1], [2, 1, 1]], the common runs of two sequences of line ids
+function matching(a, b) {
+  let p = common_head(a, b)
+  let s = common_tail(a, b, Math.min(a.length, b.length) - p)
+  let a1 = a.slice(p, a.length - s), b1 = b.slice(p, b.length - s)
+  let inner = a1.length && b1.length ? myers(a1, b1, MAX_LINE_EDITS) ?? patience(a1, b1) : []
+  let blocks = p ? [[0, 0, p]] : []
+  for (let [i, j, n] of inner) blocks.push([i + p, j + p, n])
+  if (s) blocks.push([a.length - s, b.length - s, s])
+  return blocks
+}
+
+// lines('a\nb') => { ids: [0, 1], offsets: [0, 2, 3] }
+function lines(text, table) {
+  let ids = [], offsets = [0]
+  for (let start = 0; start < text.length; ) {
+    let end = text.indexOf('\n', start) + 1 || text.length
+    let line = text.slice(start, end)
+    let id = table.get(line)
+    if (id === undefined) table.set(line, (id = table.size))
+    ids.push(id)
+    offsets.push((start = end))
+  }
+  return { ids, offsets }
+}
+
+// to_points('😀a') => i => code point index of UTF-16 index i, i must not decrease between calls
+function to_points(text) {
+  if (!/[\ud800-\udfff]/.test(text)) return i => i
+  let i16 = 0, pairs = 0
+  return i => {
+    for (; i16 < i; i16++) if (is_high_surrogate(text.charCodeAt(i16)) && i16 + 1 < i) pairs++, i16++
+    return i - pairs
+  }
+}
+
+// refine('a = 1', 'a = 2') => [[4, 1, '2']], the edits of a hunk by characters, with offsets in it
+function refine(a, b) {
+  let p = common_prefix(a, b)
+  let s = common_suffix(a, b, Math.min(a.length, b.length) - p)
+  let a1 = a.slice(p, a.length - s), b1 = b.slice(p, b.length - s)
+  let blocks = null
+  // characters are compared by UTF-16 units, which must not split a surrogate pair
+  if (a1 && b1 && a1.length + b1.length <= MAX_REFINE && !/[\ud800-\udfff]/.test(a1 + b1)) {
+    blocks = myers(a1, b1, MAX_CHAR_EDITS)
+  }
+  let edits = [], i = 0, j = 0
+  for (let [x, y, n] of [...(blocks ?? []), [a1.length, b1.length, 0]]) {
+    if (x > i || y > j) edits.push([p + i, x - i, b1.slice(j, y)])
+    i = x + n
+    j = y + n
+  }
+  return edits
+}
+
+// diff('a = 1', 'a = 2') => [[4, 1, '2']], edits of [offset, delete_length, insert_text]
+// Offsets and lengths are counted in code points, the same as points in Sublime Text.
+// The lines are diffed first, then only the changed hunks by characters, see lib/linediff.py.
+function diff(before, after) {
+  if (before === after) return []
+  let start = common_prefix(before, after)
+  let end = common_suffix(before, after, Math.min(before.length, after.length) - start)
+  let a = before.slice(start, before.length - end)
+  let b = after.slice(start, after.length - end)
+  let table = new Map()
+  let la = lines(a, table), lb = lines(b, table)
+  let point = to_points(before), edits = []
+  let i = 0, j = 0 // where the current hunk starts
+  let x0 = 0, y0 = 0 // where the last unchanged lines end
+  let n1 = la.ids.length, n2 = lb.ids.length
+  for (let [x, y, n] of [...matching(la.ids, lb.ids), [n1, n2, 0]]) {
+    let changed = x > x0 || y > y0
+    x0 = x + n
+    y0 = y + n
+    // a "}" or a blank line between two hunks is likely a coincidence, keep it in the hunk
+    if (changed && n > 0 && (x0 < n1 || y0 < n2) && la.offsets[x0] - la.offsets[x] <= MAX_WEAK) continue
+    if (x > i || y > j) {
+      let from = la.offsets[i], to = la.offsets[x], at = lb.offsets[j]
+      for (let [offset, length, text] of refine(a.slice(from, to), b.slice(at, lb.offsets[y]))) {
+        let p1 = point(start + from + offset), p2 = point(start + from + offset + length)
+        edits.push([p1, p2 - p1, text])
+      }
+    }
+    i = x0
+    j = y0
+  }
+  return edits
+}
+
+const MAX_DOCUMENTS = 100
+
+// sha1('a = 1\n') => hex digest of the utf-8 text, the same as content_hash() in lib/sync.py
+const sha1 = text => createHash('sha1').update(text).digest('hex')
+
+// to_utf16('😀a', 1) => 2, the UTF-16 index of a code point offset
+function to_utf16(text, point) {
+  let i = 0
+  for (; point > 0 && i < text.length; point--) i += is_high_surrogate(text.charCodeAt(i)) ? 2 : 1
+  return i
+}
+
+// format_ranges(prettier, 'a  =  1\nb  =  2\n', options, [[0, 1]]) => 'a = 1\nb  =  2\n'
+// The ranges are formatted as the one range enclosing them all, prettier parses the whole text
+// on every call, so one call is cheaper than one per range.
+async function format_ranges(prettier, contents, options, ranges) {
+  const start = Math.min(...ranges.map(range => range[0]))
+  const end = Math.max(...ranges.map(range => range[1]))
+  const astral = /[\ud800-\udfff]/.test(contents)
+  const rangeStart = astral ? to_utf16(contents, start) : start
+  const rangeEnd = astral ? rangeStart + to_utf16(contents.slice(rangeStart), end - start) : end
+  const { formatted } = await prettier.formatWithCursor(contents, { ...options, rangeStart, rangeEnd })
+  return formatted
+}
+
+class StaleDocument extends Error {
+  name = 'StaleDocument'
+}
+
+class Cancelled extends Error {
+  name = 'Cancelled'
+}
+
+// A request can be cancelled by a "cancel" request with its seq, or by passing its deadline.
+// Long running methods call token.check() between steps to give up early.
+class Token {
+  cancelled = false
+  listeners = []
+  constructor(deadline) {
+    this.deadline = deadline
+  }
+  cancel() {
+    this.cancelled = true
+    this.listeners.forEach(fn => fn())
+  }
+  on_cancel(fn) {
+    this.listeners.push(fn)
+  }
+  check() {
+    if (this.cancelled) throw new Cancelled('superseded')
+    if (this.deadline && Date.now() > this.deadline) throw new Cancelled('deadline exceeded')
+  }
+  async run(fn) {
+    this.check()
+    return fn()
+  }
+}
+
+// Texts of the buffers in the editor, so that a format request can send only what changed.
+class Documents extends Map {
+  uploads = new Map()
+
+  // update({ document: 1, contents: 'a' }) => { contents: 'a', hash: sha1('a') }
+  // update({ document: 1, base: 'sha1', changes: [[0, 1, 'b']], hash: 'sha1' }) => { contents: 'b', hash }
+  update({ document, contents, base, changes, hash }) {
+    if (contents == null) {
+      let doc = this.get(document)
+      if (!doc || doc.hash !== base) throw new StaleDocument(`document ${document} is not ${base}`)
+      contents = doc.contents
+      let astral = doc.astral
+      for (let [point, length, text] of changes) {
+        astral ||= /[\ud800-\udfff]/.test(text)
+        let from = astral ? to_utf16(contents, point) : point
+        let to = astral ? from + to_utf16(contents.slice(from), length) : point + length
+        contents = contents.slice(0, from) + text + contents.slice(to)
+      }
+    }
+    let digest = sha1(contents)
+    if (hash && hash !== digest) {
+      this.delete(document)
+      throw new StaleDocument(`document ${document} is not ${hash}`)
+    }
+    if (document != null) {
+      this.delete(document)
+      this.set(document, { hash: digest, contents, astral: /[\ud800-\udfff]/.test(contents) })
+      if (this.size > MAX_DOCUMENTS) this.delete(this.keys().next().value)
+    }
+    return { contents, hash: digest }
+  }
+  // append({ document: 1, chunk: 'a', first: true }) => 1, ..., append({ document: 1, chunk: 'b', hash: sha1('ab') })
+  // => sha1('ab'), a text too large for one request is sent in chunks and becomes the document with the last one.
+  append({ document, chunk, first, hash }) {
+    let parts = first ? [] : this.uploads.get(document)
+    if (!parts) throw new StaleDocument(`document ${document} is not being uploaded`)
+    parts.push(chunk)
+    this.uploads.set(document, parts)
+    if (!hash) return parts.length
+    this.uploads.delete(document)
+    return this.update({ document, contents: parts.join(''), hash }).hash
+  }
+}
+
+// approximate_size({ edits: [[0, 1, 'a']] }) => 34, bytes of a formatText result in the memory
+function approximate_size({ formatted, edits }) {
+  if (formatted != null) return 2 * formatted.length + 16
+  return (edits || []).reduce((size, [, , text]) => size + 2 * text.length + 16, 16)
+}
+
+// Results of formatText by their inputs, least recently used ones are evicted to keep in `budget` bytes.
+class ResultCache {
+  entries = new Map()
+  bytes = 0
+  hits = 0
+  misses = 0
+  constructor(budget) {
+    this.budget = budget
+  }
+  get(key) {
+    let entry = this.entries.get(key)
+    if (!entry) {
+      this.misses++
+      return
+    }
+    this.hits++
+    this.entries.delete(key)
+    this.entries.set(key, entry)
+    return entry.value
+  }
+  set(key, value) {
+    let size = approximate_size(value)
+    if (size > this.budget) return
+    this.delete(key)
+    this.entries.set(key, { value, size })
+    this.bytes += size
+    for (let [key, entry] of this.entries) {
+      if (this.bytes <= this.budget) break
+      this.delete(key)
+    }
+  }
+  delete(key) {
+    let entry = this.entries.get(key)
+    if (entry) {
+      this.bytes -= entry.size
+      this.entries.delete(key)
+    }
+  }
+  clear() {
+    this.entries.clear()
+    this.bytes = 0
+  }
+  stats() {
+    let { hits, misses, bytes, budget } = this
+    return { hits, misses, entries: this.entries.size, bytes, budget }
+  }
+}
+
+// settle([promise, ...]) => [{ ok }, { err }, ...], in the same order
+async function settle(promises) {
+  let results = await Promise.allSettled(promises)
+  return results.map(r => (r.status === 'fulfilled' ? { ok: r.value } : { err: String(r.reason) }))
+}
+
+// JSON values stored in files named by their keys under `root`.
+// Reading an entry touches it, the least recently used ones are pruned beyond `budget` bytes.
+class DiskCache {
+  bytes = null
+  writes = new Set()
+  constructor(root, budget) {
+    this.root = root
+    this.budget = budget
+  }
+  path(key) {
+    return join(this.root, key.slice(0, 2), key)
+  }
+  async get(key) {
+    let path = this.path(key)
+    let [value] = await go(readFile(path, 'utf8').then(JSON.parse))
+    if (value) utimes(path, new Date(), new Date()).catch(() => {})
+    return value
+  }
+  set(key, value) {
+    let write = this.write(key, value)
+    this.writes.add(write)
+    write.finally(() => this.writes.delete(write))
+    return write
+  }
+  // flush() waits for all writes in progress
+  async flush() {
+    await Promise.allSettled(this.writes)
+  }
+  async write(key, value) {
+    let data = Buffer.from(JSON.stringify(value))
+    if (data.length > this.budget) return
+    let path = this.path(key)
+    let [, err] = await go(
+      mkdir(dirname(path), { recursive: true })
+        .then(() => writeFile(path + '.tmp', data))
+        .then(() => rename(path + '.tmp', path)),
+    )
+    if (err) return
+    if (this.bytes == null) this.bytes = (await this.entries()).reduce((sum, e) => sum + e.size, 0)
+    else this.bytes += data.length
+    if (this.bytes > this.budget) await this.prune()
+  }
+  // prune() removes the least recently used entries until 3/4 of the budget is used
+  async prune() {
+    let entries = (await this.entries()).sort((a, b) => a.mtime - b.mtime)
+    this.bytes = entries.reduce((sum, e) => sum + e.size, 0)
+    for (let { path, size } of entries) {
+      if (this.bytes <= (this.budget * 3) / 4) break
+      let [, err] = await go(unlink(path))
+      if (!err) this.bytes -= size
+    }
+  }
+  async entries() {
+    let entries = []
+    let [folders = []] = await go(readdir(this.root))
+    for (let folder of folders) {
+      let [names = []] = await go(readdir(join(this.root, folder)))
+      for (let name of names) {
+        let path = join(this.root, folder, name)
+        let [info] = await go(stat(path))
+        if (info) entries.push({ path, size: info.size, mtime: info.mtimeMs })
+      }
+    }
+    return entries
+  }
+}
+
+const ONE_SHOT = 0x7b // '{'
+
+// frames(message => ...) => chunk => void
+// The chunks of a frame are kept as they come and concatenated once it is complete.
+function frames(on_message) {
+  let chunks = []
+  let length = 0
+  let size = -1 // of the current frame, -1 until its header is read
+  return chunk => {
+    chunks.push(chunk)
+    length += chunk.length
+    while (true) {
+      if (size < 0) {
+        if (length < 4) return
+        if (chunks[0].length < 4) chunks = [Buffer.concat(chunks, length)]
+        size = chunks[0].readUInt32BE(0)
+      }
+      if (length < 4 + size) return
+      let buffer = chunks.length > 1 ? Buffer.concat(chunks, length) : chunks[0]
+      let rest = buffer.subarray(4 + size)
+      chunks = rest.length ? [rest] : []
+      length = rest.length
+      size = -1
+      on_message(JSON.parse(buffer.toString('utf8', 4, buffer.length - rest.length)))
+    }
+  }
+}
+
+function write_frame(con, message) {
+  let body = Buffer.from(JSON.stringify(message))
+  let head = Buffer.allocUnsafe(4)
+  head.writeUInt32BE(body.length)
+  con.cork()
+  con.write(head)
+  con.write(body)
+  con.uncork()
+}
+
+// Where lib/rpc.py puts payloads, see payload_dir().
+const PAYLOAD_DIR = resolve(existsSync('/dev/shm') ? '/dev/shm' : tmpdir())
+const NOFOLLOW = constants.O_NOFOLLOW ?? 0
+
+// payload_path('/dev/shm/prettierd-xxx') => the path, if it is one lib/rpc.py would make, or throws.
+// Any local user can connect to the daemon over tcp, it must not read, remove or write other files.
+function payload_path(path) {
+  const same = process.platform === 'win32' ? (a, b) => a.toLowerCase() === b.toLowerCase() : (a, b) => a === b
+  if (
+    typeof path !== 'string' ||
+    !same(dirname(resolve(path)), PAYLOAD_DIR) ||
+    !basename(path).startsWith('prettierd-')
+  ) {
+    throw new Error(`invalid payload path: ${path}`)
+  }
+  return path
+}
+
+// read_payload({ path, size }) => the text the plugin wrote to a file (in shared memory if possible),
+// which is removed after, see write_payload() in lib/rpc.py.
+async function read_payload({ path, size }) {
+  payload_path(path)
+  try {
+    const data = await readFile(path, { flag: constants.O_RDONLY | NOFOLLOW })
+    return data.toString('utf8', 0, size)
+  } finally {
+    await unlink(path).catch(() => {})
+  }
+}
+
+// Worker threads running the heavy methods (formatText), each has its own prettier.
+// A job goes to the worker with the fewest jobs in flight.
+// They start once the main thread has loaded prettier, not to slow down the start.
+class Pool {
+  seq = 0
+  workers = []
+  constructor(size, loaded) {
+    loaded.then(() => {
+      for (let i = 0; i < size; i++) this.spawn()
+    }, () => {})
+  }
+  spawn() {
+    let worker = new Worker(new URL(import.meta.url))
+    worker.jobs = new Map()
+    worker.on('message', ({ id, ok, err, ready }) => {
+      if (ready) return (worker.ready = true)
+      let job = worker.jobs.get(id)
+      worker.jobs.delete(id)
+      if (err) job.reject(err)
+      else job.resolve(ok)
+    })
+    worker.on('error', err => console.error(err.message))
+    worker.on('exit', () => {
+      this.workers = this.workers.filter(w => w !== worker)
+      worker.jobs.forEach(job => job.reject('WorkerExited'))
+      // a worker which failed to start would fail again, only replace crashed ones
+      if (worker.ready) this.spawn()
+    })
+    this.workers.push(worker)
+  }
+  // run('formatText', params, token) => Promise, or null if it cannot be sent to a worker
+  run(method, params, token) {
+    let worker = this.workers.reduce((a, b) => (b.jobs.size < a.jobs.size ? b : a), this.workers[0])
+    if (!worker) return null
+    let id = ++this.seq
+    try {
+      worker.postMessage({ id, method, params, deadline: token.deadline })
+    } catch {
+      return null
+    }
+    token.on_cancel(() => worker.postMessage({ cancel: id }))
+    return new Promise((resolve, reject) => worker.jobs.set(id, { resolve, reject }))
+  }
+}
+
+const ADDRESS = Symbol('address')
 const MODULE = Symbol('module')
+const DOCUMENTS = Symbol('documents')
+const POOL = Symbol('pool')
+const CACHE = Symbol('cache')
+const DISK_CACHE = Symbol('diskCache')
+const RUN = Symbol('run')
 const HANDLE = Symbol('handle')
+const DISPATCH = Symbol('dispatch')
 const ON_QUIT = Symbol('onQuit')
 
 class Prettied {
   constructor(on_quit) {
-    this[PORT] = get_port()
+    this[ADDRESS] = get_address()
     this[MODULE] = import_prettier()
+    this[DOCUMENTS] = new Documents()
+    this[POOL] = isMainThread && get_workers() > 0 ? new Pool(get_workers(), this[MODULE]) : null
+    this[CACHE] = new ResultCache(get_cache_size())
+    let [cache_dir, disk_cache_size] = get_disk_cache()
+    this[DISK_CACHE] =
+      isMainThread && cache_dir && disk_cache_size > 0 ? new DiskCache(cache_dir, disk_cache_size) : null
     this[ON_QUIT] = on_quit
   }
   [HANDLE](con) {
     let chunks = []
-    con.on('data', chunk => chunks.push(chunk))
-    con.on('end', async () => {
-      let raw = Buffer.concat(chunks).toString()
-      const { id, method, params } = JSON.parse(raw)
-      if (method === 'quit') {
-        this[ON_QUIT](con)
-      } else if (method in this) {
-        const [ok, err] = await go(this[method](params))
-        if (err) {
-          con.end(JSON.stringify({ id, err: String(err) }))
-        } else {
-          con.end(JSON.stringify({ id, ok }))
-        }
+    let tokens = new Map()
+    let on_frame = frames(async message => {
+      let response = await this[DISPATCH](message, tokens)
+      if (con.writable) write_frame(con, response)
+      if (message.method === 'quit') {
+        con.end()
+        this[ON_QUIT]()
+      }
+    })
+    con.on('error', () => {})
+    con.on('data', chunk => {
+      if (chunks && (chunks.length || chunk[0] === ONE_SHOT)) {
+        chunks.push(chunk)
       } else {
-        con.end(JSON.stringify({ id, err: 'NoSuchMethod: ' + method }))
+        chunks = null
+        on_frame(chunk)
       }
     })
+    con.on('end', async () => {
+      if (!chunks?.length) return con.end()
+      let message = JSON.parse(Buffer.concat(chunks).toString())
+      con.end(JSON.stringify(await this[DISPATCH](message, tokens)))
+      if (message.method === 'quit') this[ON_QUIT]()
+    })
+  }
+  async [DISPATCH]({ id, seq, method, params, deadline }, tokens) {
+    id ??= seq
+    if (method === 'quit') {
+      return { id, err: 'quit' }
+    } else if (method === 'cancel') {
+      let token = tokens.get(params?.seq)
+      if (token) token.cancel()
+      return { id, ok: !!token }
+    } else if (method in this) {
+      let token = new Token(deadline)
+      tokens.set(id, token)
+      let [ok, err] = await go(token.run(() => this[method](params, token)))
+      tokens.delete(id)
+      // a large result goes through the file given by the plugin instead of the socket
+      if (!err && params?.reply && !token.cancelled) {
+        const data = Buffer.from(JSON.stringify(ok ?? null))
+        const flag = constants.O_WRONLY | constants.O_CREAT | constants.O_TRUNC | NOFOLLOW
+        const write = async () => writeFile(payload_path(params.reply), data, { mode: 0o600, flag })
+        const [, failed] = await go(write())
+        err = failed
+        ok = { payload: { path: params.reply, size: data.length } }
+      }
+      if (err) {
+        return { id, err: String(err) }
+      } else {
+        return { id, ok }
+      }
+    } else {
+      return { id, err: 'NoSuchMethod: ' + method }
+    }
+  }
+  async [RUN](method, params, token) {
+    return this[POOL]?.run(method, params, token) ?? this[method](params, token)
   }
   async getSupportInfo(_) {
     let { default: prettier } = await this[MODULE]
@@ -151,18 +898,97 @@ class Prettied {
     let { default: prettier } = await this[MODULE]
     return prettier.getFileInfo(path, { resolveConfig: true })
   }
+  // Results are [{ ok }, { err }, ...] in the same order as `paths`.
+  async getFileInfoMany({ paths }) {
+    return settle(paths.map(path => this.getFileInfo({ path })))
+  }
   async clearConfigCache(_) {
     let { default: prettier } = await this[MODULE]
     prettier.clearConfigCache()
+    this[CACHE].clear()
     return null
   }
-  async format({ path, contents, parser, cursor }) {
+  // With `edits: true`, returns { edits: [[offset, delete_length, insert_text], ...], cursorOffset }
+  // or { unchanged: true, cursorOffset } instead of the whole formatted text.
+  // With `document`, the contents can be given as `changes` since the last request, see Documents.
+  // With `ranges` ([[start, end], ...] in code points), only the statements around them are formatted.
+  async format({ path, parser, cursor, edits, ranges, ...params }, token = new Token()) {
+    let { contents, hash } = this[DOCUMENTS].update(params)
     let { default: prettier } = await this[MODULE]
+    token.check()
     const config = await prettier.resolveConfig(path)
+    token.check()
     // `filepath` is required for preserving <T> in .ts files instead of generating <T,>.
     // https://github.com/prettier/prettier/blob/724bb0c/src/language-js/print/type-parameters.js#L36-L48
     const options = { ...config, filepath: path, parser, cursorOffset: cursor }
-    return prettier.formatWithCursor(contents, options)
+    if (ranges) options.cursorOffset = undefined
+    const key = sha1(JSON.stringify([options, hash, !!edits, ranges]))
+    let result = this[CACHE].get(key)
+    if (result) return result
+    // the disk cache survives restarts, so its entries must also be keyed by prettier's version
+    const disk_key = this[DISK_CACHE] && sha1(prettier.version + '\0' + key)
+    result = disk_key && (await this[DISK_CACHE].get(disk_key))
+    if (!result) {
+      result = await this[RUN]('formatText', { contents, options, edits, ranges }, token)
+      // a worker only hears of a cancel after prettier returns, a superseded result is not kept
+      token.check()
+      if (disk_key) this[DISK_CACHE].set(disk_key, result)
+    }
+    this[CACHE].set(key, result)
+    return result
+  }
+  // The CPU heavy part of format, runs in a worker thread if there are any.
+  async formatText({ contents, options, edits, ranges }, token = new Token()) {
+    let { default: prettier } = await this[MODULE]
+    const result = ranges
+      ? { formatted: await format_ranges(prettier, contents, options, ranges), cursorOffset: -1 }
+      : await prettier.formatWithCursor(contents, options)
+    token.check()
+    if (!edits) return result
+    const { formatted, cursorOffset } = result
+    if (formatted === contents) return { unchanged: true, cursorOffset }
+    return { edits: diff(contents, formatted), cursorOffset }
+  }
+  // formatFile({ ...params of format, mtime, size }) formats the file at `path` read from the disk,
+  // which is what a clean buffer has, so its text needs not be sent. The file must still have the
+  // mtime (ms) and size the plugin saw, and the `hash` of the buffer, or it fails with StaleDocument.
+  async formatFile({ mtime, size, ...params }, token) {
+    // without the hash of what the plugin has, it would read any file for any local user
+    if (typeof params.hash !== 'string') throw new Error('formatFile: no hash')
+    const info = await stat(params.path)
+    if (info.size !== size || Math.abs(info.mtimeMs - mtime) > 1) {
+      throw new StaleDocument(`file ${params.path} has changed`)
+    }
+    token.check()
+    params.contents = await readFile(params.path, 'utf8')
+    return this.format(params, token)
+  }
+  // formatRanges({ ...params of format, ranges }) => the same as format, but only from the first
+  // range to the last one, prettier still parses the whole file once.
+  async formatRanges(params, token) {
+    if (!params.ranges?.length) throw new Error('formatRanges: no ranges')
+    return this.format(params, token)
+  }
+  // Results are [{ ok }, { err }, ...] in the same order as `items`, each item is the params of format,
+  // or of formatFile if it has the `mtime`.
+  async formatMany({ items }, token) {
+    return settle(items.map(item => (item.mtime != null ? this.formatFile(item, token) : this.format(item, token))))
+  }
+  // cacheStats() => { hits, misses, entries, bytes, budget } of the format result cache
+  cacheStats(_) {
+    return this[CACHE].stats()
+  }
+  // upload({ document, chunk, first, hash }), see Documents.append, then format it with
+  // { document, base: hash, changes: [], hash } like any other document.
+  // The chunk can be a { payload: { path, size } } written by the plugin instead, see read_payload.
+  async upload({ payload, ...params }) {
+    if (payload) params.chunk = await read_payload(payload)
+    return this[DOCUMENTS].append(params)
+  }
+  async closeDocument({ document }) {
+    this[DOCUMENTS].delete(document)
+    this[DOCUMENTS].uploads.delete(document)
+    return null
   }
   ping(_) {
     return 'pong'
@@ -172,13 +998,23 @@ class Prettied {
 async function main() {
   let server
 
-  let prettierd = new Prettied(con => {
-    con.end(JSON.stringify({ id, err: 'quit' }))
-    server.close(() => console.log(JSON.stringify({ ok: 'closed' })))
+  let prettierd = new Prettied(async () => {
+    await prettierd[DISK_CACHE]?.flush()
+    server.close(() => {
+      console.log(JSON.stringify({ ok: 'closed' }))
+      exit(0)
+    })
+    // other framed connections are long-lived, do not wait for them forever
+    setTimeout(exit, 1000, 0)
   })
 
-  let { [PORT]: port, [HANDLE]: handler } = prettierd
-  server = create_server(port, handler.bind(prettierd))
+  let { [ADDRESS]: address, [HANDLE]: handler } = prettierd
+  server = create_server(address, handler.bind(prettierd), async () => {
+    const listen = elapsed(0)
+    // requests are taken while prettier loads, but the plugin is told only when it can format
+    await go(prettierd[MODULE])
+    console.log(JSON.stringify({ ok: address, time: { ...TIMINGS, listen } }))
+  })
 
   let terminate = () => {
     server.close()
@@ -193,4 +1029,23 @@ async function main() {
   }
 }
 
-main().catch(() => exit(1))
+function worker_main() {
+  let prettierd = new Prettied()
+  let tokens = new Map()
+  prettierd[MODULE].then(() => parentPort.postMessage({ ready: true }))
+  parentPort.on('message', async ({ id, method, params, deadline, cancel }) => {
+    if (cancel) return tokens.get(cancel)?.cancel()
+    let token = new Token(deadline)
+    tokens.set(id, token)
+    const [ok, err] = await go(token.run(() => prettierd[method](params, token)))
+    tokens.delete(id)
+    parentPort.postMessage(err ? { id, err: String(err) } : { id, ok })
+  })
+}
+
+enable_compile_cache()
+if (isMainThread) {
+  main().catch(() => exit(1))
+} else {
+  worker_main()
+}
@@ -3,8 +3,12 @@
 #
 import sublime, sublime_plugin
 import os, pathlib, socket, json, subprocess, threading, fnmatch
-from .lib.diff_match_patch import diff_match_patch
-from .lib.utils import tcp_request, make_request, get_file_extension_from_view, get_parser_from_ext
+from .lib import linediff
+from .lib.client import Client
+from .lib.rpc import reply_path, write_payload, read_payload, remove_payload
+from .lib.scheduler import Scheduler
+from .lib.sync import Document, DirtyRanges, content_hash
+from .lib.utils import tcp_request, get_socket_path, standby_address, get_file_extension_from_view, get_parser_from_ext
 
 __version__ = "0.2.0"
 
@@ -12,32 +16,72 @@ script = pathlib.Path(__file__).parent.joinpath('prettierd.mjs').resolve()
 
 save_without_format = False
 
+CHUNK_SIZE = 1 << 20
+
 server = ('localhost', 9870)
-seq = 0
-ready = False
-respawning = False
+standby = None # address of the warm standby daemon, if enabled
+addresses = (server, None) # the daemon and the standby take turns on these
+standby_spawning = threading.Lock()
+client = Client(server)
+documents = {}
+dirty = {}
+formatting = {}
+computed = {}
+scheduler = Scheduler()
+verified = {}
 
 
 def load_settings():
     return sublime.load_settings('prettier.sublime-settings')
 
 
-def call(*args, **kwargs):
-    global seq
-    seq += 1
-    return tcp_request(server, make_request(*args, seq=seq, **kwargs))
+def call(method, params=None, timeout=None):
+    return client.call(method, params, timeout)
+
+
+# then(client.request(...), lambda response: ...) runs the callback on the async thread,
+# or respawns the daemon if the request failed, after calling `failed()`.
+def then(future, callback, failed=None):
+    def done(future):
+        try:
+            response = future.result()
+        except TimeoutError:
+            if failed: failed()
+            status_error('Prettier: timeout.')
+            return sublime.set_timeout_async(check_alive)
+        except:
+            if failed: failed()
+            return sublime.set_timeout_async(regenerate)
+        sublime.set_timeout_async(lambda: callback(response))
+    future.add_done_callback(done)
+
+
+def check_alive():
+    try:
+        call("ping", timeout=1)
+    except:
+        regenerate()
 
 
 def plugin_loaded():
-    global server
+    global server, standby, addresses
     settings = load_settings()
     port = settings.get('port') or 9870
     if port != 9870: server = ('localhost', port)
+    if settings.get('transport') == 'unix' and sublime.platform() != 'windows':
+        server = get_socket_path()
+    client.server = server
+    addresses = (server, standby_address(server))
+    standby = addresses[1] if settings.get('standby') else None
+    settings.add_on_change('prettierd', on_settings_changed)
+    client.timeout = settings.get('timeout') or None
     # try get existing server
     sublime.set_timeout_async(knock_knock)
 
 
 def plugin_unloaded():
+    load_settings().clear_on_change('prettierd')
+    client.stop()
     sublime.set_timeout_async(clear_status)
 
 
@@ -49,46 +93,86 @@ def clear_status():
 
 def quit_away():
     try:
-        call("quit")
+        call("quit", timeout=1)
+    except:
+        pass
+    client.close()
+
+
+# quit_standby(('localhost', 9871)) stops the standby daemon, it does not know when the editor exits
+def quit_standby(address):
+    try:
+        tcp_request(address, { "method": "quit" }, timeout=1)
+    except:
+        pass
+
+
+def on_settings_changed():
+    global standby
+    enabled = bool(load_settings().get('standby'))
+    if enabled == bool(standby): return
+    if enabled:
+        standby = next(address for address in addresses if address != server)
+        sublime.set_timeout_async(spawn_standby)
+    else:
+        address, standby = standby, None
+        sublime.set_timeout_async(lambda: quit_standby(address))
+
+
+def close_document(buffer_id):
+    try:
+        call("closeDocument", { "document": buffer_id })
     except:
         pass
 
 
 def knock_knock():
-    global ready
     try:
-        data = call("ping")
-        response = sublime.decode_value(data)
+        response = call("ping", timeout=2)
         if "ok" in response:
             print("prettierd: use existing server")
             status_verbose("Prettier: ready.")
-            ready = True
+            client.set_ready(True)
             sublime.set_timeout_async(refresh_views)
-            return
+            return spawn_standby()
     except:
         pass
+    # the standby may have been serving before a plugin reload
+    if promote(): return
     # no existing server, spawn one
     quit_away()
     spawn_subprocess()
 
 
-def spawn_subprocess():
-    global ready
-    print("prettierd: spawning subprocess")
-    status_verbose("Prettier: warming up...")
+# start_daemon(('localhost', 9870)) => '{"ok":9870}\n', the first line printed by the daemon
+def start_daemon(address):
     si = None
     if sublime.platform() == "windows":
         si = subprocess.STARTUPINFO()
         si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    address = address if isinstance(address, str) else str(address[1])
+    settings = load_settings()
+    env = dict(os.environ,
+        WORKERS=str(settings.get('workers', 2)),
+        CACHE_SIZE=str(settings.get('cache_size', 33554432)),
+        CACHE_DIR=os.path.join(sublime.cache_path(), 'prettierd', 'results'),
+        COMPILE_CACHE_DIR=os.path.join(sublime.cache_path(), 'prettierd', 'compile'),
+        DISK_CACHE_SIZE=str(settings.get('disk_cache_size') or 0))
     proc = subprocess.Popen(
-        ["node", script, str(server[1]), str(os.getpid())],
+        ["node", script, address, str(os.getpid())],
         startupinfo=si,
+        env=env,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         text=True,
     )
-    io = proc.stdout
-    res = io.readline()
+    return proc.stdout.readline()
+
+
+def spawn_subprocess():
+    print("prettierd: spawning subprocess")
+    status_verbose("Prettier: warming up...")
+    res = start_daemon(server)
     if "EADDRINUSE" in res:
         print("prettierd: conflict with existing server?")
         quit_away()
@@ -97,29 +181,92 @@ def spawn_subprocess():
     if "ok" in sublime.decode_value(res):
         print("prettierd: spawn success")
         status_verbose("Prettier: ready.")
-        ready = True
+        client.set_ready(True)
         sublime.set_timeout_async(refresh_views)
-        return
+        return spawn_standby()
+
+
+# is_alive(('localhost', 9871)) => True if a daemon answers "ping" there
+def is_alive(address):
+    try:
+        return "ok" in sublime.decode_value(tcp_request(address, { "method": "ping" }, timeout=1))
+    except:
+        return False
+
 
+# spawn_standby() starts a second daemon in the background, which takes over at once
+# when the current one dies or is restarted, instead of waiting for a cold start.
+def spawn_standby():
+    if standby: threading.Thread(target=_spawn_standby, daemon=True).start()
 
-def regenerate():
-    global respawning
-    if respawning: return
-    print("prettierd: server down, respawning...")
-    respawning = True
-    ready = False
+
+def _spawn_standby():
+    if not standby_spawning.acquire(blocking=False): return
+    try:
+        address = standby
+        if is_alive(address): return
+        res = start_daemon(address)
+        if "EADDRINUSE" in res:
+            # the old daemon may still be closing there
+            return sublime.set_timeout_async(spawn_standby, 3000)
+        print("prettierd: standby", res, end='')
+    finally:
+        standby_spawning.release()
+
+
+# promote() => True if the standby daemon took over, then a new standby is spawned
+def promote():
+    global server, standby
+    if not standby or not is_alive(standby): return False
     quit_away()
-    spawn_subprocess()
-    respawning = False
+    # the standby may have loaded another prettier
+    verified.clear()
+    server, standby = standby, server
+    client.server = server
+    print("prettierd: switched to standby", server)
+    status_verbose("Prettier: ready.")
+    client.set_ready(True)
+    sublime.set_timeout_async(refresh_views)
+    spawn_standby()
+    return True
+
+
+# regenerate(restart=False) respawns the daemon if it is down, or anyway if restart
+def regenerate(restart=False):
+    if not client.begin_respawn(): return
+    # every request failed by the same crash calls this, the first one has already replaced the daemon
+    if not restart and is_alive(server):
+        client.set_ready(True)
+    elif not promote():
+        print("prettierd: server down, respawning...")
+        verified.clear()
+        quit_away()
+        spawn_subprocess()
+    client.end_respawn()
 
 
 def refresh_views():
+    views, paths = [], []
     for window in sublime.windows():
         for view in window.views():
-            check_formattable(view)
+            if filename := file_info_path(view):
+                views.append(view)
+                paths.append(filename)
+    if not paths: return
+    def done(response):
+        for view, result in zip(views, response.get("ok") or []):
+            set_file_info_status(view, result)
+    then(client.request('getFileInfoMany', { "paths": paths }), done)
 
 
 def check_formattable(view):
+    filename = file_info_path(view)
+    if not filename: return
+    then(client.request('getFileInfo', { "path": filename }), lambda response: set_file_info_status(view, response))
+
+
+# file_info_path(view) => "path/to/a.js" if it needs a "getFileInfo" to know its parser
+def file_info_path(view):
     if view.get_status("prettier"): return
     filename = view.file_name()
     if not filename:
@@ -130,11 +277,10 @@ def check_formattable(view):
         return view.set_status("prettier", f"Prettier (ignored)")
     if parser := is_overridden(filename):
         return view.set_status("prettier", f"Prettier ({parser})")
-    try:
-        data = call('getFileInfo', { "path": filename })
-    except:
-        return sublime.set_timeout_async(regenerate)
-    response = sublime.decode_value(data)
+    return filename
+
+
+def set_file_info_status(view, response):
     if "ok" in response:
         ok = response["ok"]
         if "inferredParser" in ok:
@@ -144,6 +290,31 @@ def check_formattable(view):
             view.set_status("prettier", f"Prettier (ignored)")
 
 
+# format_params(view) => { "path": "a.js", "parser": "babel", ... } or None if it should not be formatted
+def format_params(view, force=False):
+    settings = load_settings()
+    status = view.get_status('prettier')
+    if not status: return
+    parser = status[10:-1]
+    if not force and parser in ('off', 'ignored'): return
+    path = view.file_name()
+    ext = None
+    if path:
+        i = path.rfind('.')
+        if i != -1:
+            ext = path[i:]
+    if not path:
+        ext = get_file_extension_from_view(view)
+        if not ext: return
+        path = "main" + ext
+    if parser in ('off', 'ignored'):
+        parser = get_parser_from_ext(ext)
+        if not parser: return
+    cursor = s[0].b if (s := view.sel()) else 0
+    if parser == 'svelte' or not settings.get("cursor", False): cursor = None
+    return { "path": path, "parser": parser, "cursor": cursor, "edits": True }
+
+
 def is_ignored(filename):
     settings = load_settings()
     filename = os.path.basename(filename)
@@ -160,6 +331,52 @@ def is_overridden(filename):
     return None
 
 
+# mark_verified(view) records that the text of the view is formatted as it is now,
+# the hash is computed later on the async thread if not given.
+def mark_verified(view, change_count=None, digest=None):
+    buffer_id = view.buffer_id()
+    change_count = view.change_count() if change_count is None else change_count
+    verified[buffer_id] = [change_count, digest]
+    if digest is None:
+        sublime.set_timeout_async(lambda: hash_verified(view, buffer_id, change_count))
+
+
+def hash_verified(view, buffer_id, change_count):
+    entry = verified.get(buffer_id)
+    if entry and entry[0] == change_count == view.change_count():
+        entry[1] = content_hash(view.substr(sublime.Region(0, view.size())))
+
+
+# is_verified(view) => True if the text of the view is known to be formatted, without asking the daemon
+def is_verified(view):
+    entry = verified.get(view.buffer_id())
+    if not entry: return False
+    change_count = view.change_count()
+    if entry[0] == change_count: return True
+    # hashing a large buffer on the UI thread costs more than asking the daemon
+    if entry[1] and not too_large(view) and entry[1] == content_hash(view.substr(sublime.Region(0, view.size()))):
+        entry[0] = change_count
+        return True
+    return False
+
+
+# file_stat(view) => os.stat() of the file if it has exactly the text of the view, or None
+def file_stat(view):
+    path = view.file_name()
+    if not path or view.is_dirty() or view.encoding() != 'UTF-8' or view.line_endings() != 'Unix': return
+    try:
+        return os.stat(path)
+    except OSError:
+        return
+
+
+def too_large(view):
+    settings = load_settings()
+    max_size = settings.get('max_size') or 10240
+    if max_size < 0: max_size = 10240
+    return view.size() >= max_size
+
+
 def is_status_verbose():
     settings = load_settings()
     return settings.get('status_level') == 'verbose'
@@ -174,27 +391,140 @@ def status_error(message):
     sublime.status_message(message)
 
 
+class FormatJob:
+    """A "format" request of the view's current text, synced through its Document.
+
+    A `shared` job sends the text and gets the result back through files in shared memory.
+    A clean buffer is read by the daemon from its file ("formatFile") instead of being sent.
+    """
+
+    def __init__(self, view, params, shared=False):
+        self.view = view
+        self.params = params
+        self.shared = shared
+        self.payload = None
+        self.reply = None
+        self.change_count = view.change_count()
+        self.contents = view.substr(sublime.Region(0, view.size()))
+        self.buffer_id = view.buffer_id()
+        self.document = documents.setdefault(self.buffer_id, Document())
+        self.digest = content_hash(self.contents)
+        self.sync = self.document.params(self.buffer_id, self.contents, self.digest, self.change_count)
+        self.retried = False
+        # the daemon can read a clean buffer from its file instead
+        if "contents" in self.sync and (stat := file_stat(view)):
+            self.sync = { "document": self.buffer_id, "hash": self.digest, "mtime": stat.st_mtime_ns / 1e6, "size": stat.st_size }
+
+    # method("format") => "formatFile" if the request reads the file, or the given method
+    def method(self, method):
+        return "formatFile" if "mtime" in self.sync else method
+
+    def request(self):
+        if not self.shared: return { **self.params, **self.sync }
+        self.reply = reply_path()
+        return { **self.params, **self.sync, "reply": self.reply }
+
+    # unwrap(response) => the response with the result read back from the reply file
+    def unwrap(self, response):
+        reply, self.reply = self.reply, None
+        if not reply: return response
+        ok = response.get("ok")
+        if isinstance(ok, dict) and "payload" in ok:
+            return { **response, "ok": read_payload(ok["payload"]) }
+        remove_payload(reply)
+        return response
+
+    def is_stale(self, response):
+        return "contents" not in self.sync and response.get("err", "").startswith("StaleDocument")
+
+    # chunks() => params of "upload" requests, each has a part of the text and the "progress" in percent
+    def chunks(self):
+        if self.shared:
+            payload = write_payload(self.contents)
+            self.payload = payload["path"]
+            yield { "document": self.buffer_id, "payload": payload, "first": True, "hash": self.digest, "progress": 0 }
+            return
+        size = len(self.contents)
+        for i in range(0, size, CHUNK_SIZE):
+            params = { "document": self.buffer_id, "chunk": self.contents[i:i + CHUNK_SIZE], "progress": i * 100 // size }
+            if i == 0: params["first"] = True
+            if i + CHUNK_SIZE >= size: params["hash"] = self.digest
+            yield params
+
+    # uploaded() => the request of the text sent by chunks()
+    def uploaded(self):
+        self.sync = { "document": self.buffer_id, "base": self.digest, "changes": [], "hash": self.digest }
+        return self.request()
+
+    def full_request(self):
+        self.sync = { "document": self.buffer_id, "contents": self.contents }
+        return self.request()
+
+    def finish(self, response, save_on_format=False):
+        self.document.synced(self.digest, self.change_count)
+        if "ok" in response:
+            if self.view.change_count() != self.change_count:
+                status_verbose('Prettier: buffer changed, skipped.')
+            elif response["ok"].get("unchanged"):
+                mark_verified(self.view, self.change_count, self.digest)
+                status_verbose('Prettier: unchanged.')
+            else:
+                computed[self.buffer_id] = [self.change_count, response["ok"]["edits"]]
+                self.view.run_command("prettier_format", {
+                    "edits": True,
+                    "change_count": self.change_count,
+                    "cursor": response["ok"]["cursorOffset"],
+                    "save_on_format": save_on_format
+                })
+        elif response.get("err", "").startswith("Cancelled"):
+            status_verbose(f'Prettier: {response["err"]}.')
+        elif "err" in response:
+            print(response["err"])
+            status_error('Prettier: open console to see error message.')
+
+
 class PrettierFormat(sublime_plugin.TextCommand):
-    def run(self, edit, save_on_format=False, force=False, formatted=None, cursor=None):
-        if not ready: return
-        if formatted:
-            self.replace(edit, formatted, cursor=cursor, save_on_format=save_on_format)
+    # edits: True to apply the edits computed for the buffer at change_count, see `computed`
+    def run(self, edit, save_on_format=False, force=False, formatted=None, edits=False, change_count=None, cursor=None, ranges=None):
+        if not client.ready: return
+        if edits:
+            self.apply(edit, change_count, cursor=cursor, save_on_format=save_on_format)
+        elif formatted:
+            self.replace(formatted, cursor=cursor, save_on_format=save_on_format)
         else:
-            self.format(save_on_format=save_on_format, force=force)
-
-    def replace(self, edit, formatted, cursor=None, save_on_format=False):
-        original = self.view.substr(sublime.Region(0, self.view.size()))
-        patches = diff_match_patch().patch_make(original, formatted)
-        for obj in patches:
-            point = obj.start1
-            for i, text in obj.diffs:
-                if i == 0:
-                    point += len(text)
-                elif i == 1:
-                    self.view.insert(edit, point, text)
-                    point += len(text)
-                elif i == -1:
-                    self.view.erase(edit, sublime.Region(point, point + len(text)))
+            self.format(save_on_format=save_on_format, force=force, ranges=ranges, change_count=change_count)
+
+    def apply(self, edit, change_count, cursor=None, save_on_format=False):
+        entry = computed.pop(self.view.buffer_id(), None)
+        if not entry or entry[0] != change_count or self.view.change_count() != change_count:
+            return status_verbose('Prettier: buffer changed, skipped.')
+        for offset, length, text in reversed(entry[1]):
+            if text:
+                self.view.replace(edit, sublime.Region(offset, offset + length), text)
+            else:
+                self.view.erase(edit, sublime.Region(offset, offset + length))
+        self.done(cursor=cursor, save_on_format=save_on_format)
+
+    # The diff is computed on the async thread, only applying its edits blocks the UI.
+    def replace(self, formatted, cursor=None, save_on_format=False):
+        sublime.set_timeout_async(lambda: self._replace(formatted, cursor, save_on_format))
+
+    def _replace(self, formatted, cursor=None, save_on_format=False):
+        view, buffer_id = self.view, self.view.buffer_id()
+        change_count = view.change_count()
+        edits = linediff.compact(view.substr(sublime.Region(0, view.size())), formatted)
+        if not edits: return status_verbose('Prettier: unchanged.')
+        if view.change_count() != change_count: return status_verbose('Prettier: buffer changed, skipped.')
+        computed[buffer_id] = [change_count, edits]
+        self.view.run_command("prettier_format", {
+            "edits": True,
+            "change_count": change_count,
+            "cursor": cursor,
+            "save_on_format": save_on_format
+        })
+
+    def done(self, cursor=None, save_on_format=False):
+        mark_verified(self.view)
         if cursor and cursor > 0:
             sel = self.view.sel()
             sel.clear()
@@ -205,97 +535,115 @@ class PrettierFormat(sublime_plugin.TextCommand):
         else:
             status_verbose('Prettier: formatted.')
 
-    def format(self, save_on_format=False, force=False):
-        sublime.set_timeout_async(lambda: self._format(save_on_format=save_on_format, force=force))
-
-    def _format(self, save_on_format=False, force=False):
-        settings = load_settings()
-        status = self.view.get_status('prettier')
-        if not status: return status_error('Prettier: not ready.')
-        parser = status[10:-1]
-        if not force and parser in ('off', 'ignored'): return
-        path = self.view.file_name()
-        if self._too_large(): return self._format_manually(path, save_on_format=save_on_format)
-        ext = None
-        if path:
-            i = path.rfind('.')
-            if i != -1:
-                ext = path[i:]
-        if not path:
-            ext = get_file_extension_from_view(self.view)
-            if not ext: return
-            path = "main" + ext
-        if parser in ('off', 'ignored'):
-            parser = get_parser_from_ext(ext)
-            if not parser: return
-        contents = self.view.substr(sublime.Region(0, self.view.size()))
-        cursor = s[0].b if (s := self.view.sel()) else 0
-        if parser == 'svelte' or not settings.get("cursor", False): cursor = None
-        params = { "path": path, "contents": contents, "parser": parser, "cursor": cursor }
-        try:
-            data = call("format", params)
-        except:
-            return sublime.set_timeout_async(regenerate)
-        response = sublime.decode_value(data)
-        if "ok" in response and "formatted" in response["ok"]:
-            if response["ok"]["formatted"] == contents:
-                status_verbose('Prettier: unchanged.')
-            else:
-                self.view.run_command("prettier_format", {
-                    "formatted": response["ok"]["formatted"],
-                    "cursor": response["ok"]["cursorOffset"],
-                    "save_on_format": save_on_format
-                })
-        elif "err" in response:
-            print(response["err"])
-            status_error('Prettier: open console to see error message.')
-
-    def _format_manually(self, path: str, save_on_format=False):
+    # ranges: [[start, end], ...] against the buffer at change_count, only format around them
+    def format(self, save_on_format=False, force=False, ranges=None, change_count=None):
+        sublime.set_timeout_async(lambda: self._format(save_on_format, force, ranges, change_count))
+
+    def _format(self, save_on_format=False, force=False, ranges=None, change_count=None):
+        if not self.view.get_status('prettier'): return status_error('Prettier: not ready.')
+        params = format_params(self.view, force=force)
+        if not params: return
+        buffer_id = self.view.buffer_id()
+        # the format in flight is for an older text, let the daemon drop it
+        previous = formatting.get(buffer_id)
+        if previous and not previous.done() and previous.change_count != self.view.change_count():
+            client.cancel(previous.seq)
+        scheduler.submit(buffer_id, lambda done: self._run(done, save_on_format, force, ranges, change_count))
+
+    # Scheduled by _format, at most one runs per buffer and it reads the latest text.
+    def _run(self, done, save_on_format=False, force=False, ranges=None, change_count=None):
+        params = self.view.is_valid() and format_params(self.view, force=force)
+        if not params: return done()
+        method = "format"
+        if ranges:
+            if self.view.change_count() != change_count:
+                status_verbose('Prettier: buffer changed, skipped.')
+                return done()
+            method = "formatRanges"
+            params = { **params, "ranges": ranges }
         settings = load_settings()
-        si = None
-        is_windows = sublime.platform() == "windows"
-        cmd = "prettier.cmd" if is_windows else "prettier"
-        cursor = self.view.sel()[0].a
-        if is_windows:
-            si = subprocess.STARTUPINFO()
-            si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        try:
-            args = [cmd, path]
-            if settings.get("cursor", False):
-                args.append('--cursor-offset')
-                args.append(str(cursor))
-            proc = subprocess.Popen(
-                args,
-                startupinfo=si,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                encoding='utf-8',
-            )
-            stdout, stderr = proc.communicate(timeout=5)
-        except subprocess.TimeoutExpired:
-            proc.kill()
-            status_error("Prettier: timeout.")
-            return
-        if proc.returncode != 0:
-            print(stderr)
-            status_error("Prettier: open console to see error message.")
-            return
-        if stderr:
-            cursor = int(stderr)
-        if stdout == self.view.substr(sublime.Region(0, self.view.size())):
-            status_verbose('Prettier: unchanged.')
+        threshold = settings.get('shared_memory_threshold') or 0
+        job = FormatJob(self.view, params, shared=0 < threshold <= self.view.size())
+        # too large for one request, it is uploaded in chunks (or as a payload) and given more time to format
+        large = too_large(self.view) or job.shared
+        timeout = settings.get('large_timeout') if too_large(self.view) else None
+        def failed():
+            for path in (job.payload, job.reply):
+                if path: remove_payload(path)
+            job.document.reset()
+            done()
+        # an error in a callback must still end the job, or later ones of the buffer never run
+        def guarded(callback):
+            def run(response):
+                try:
+                    callback(response)
+                except:
+                    failed()
+                    raise
+            return run
+        def upload(chunks):
+            params = next(chunks, None)
+            if params is None:
+                sublime.status_message('Prettier: formatting...')
+                return send(job.uploaded())
+            sublime.status_message(f'Prettier: uploading {params.pop("progress")}%...')
+            then(client.request("upload", params, timeout), guarded(uploaded(chunks)), failed)
+        def uploaded(chunks):
+            def callback(response):
+                if "ok" in response: return upload(chunks)
+                print(response.get("err"))
+                status_error('Prettier: open console to see error message.')
+                failed()
+            return callback
+        def send(params):
+            future = formatting[job.buffer_id] = client.request(job.method(method), params, timeout)
+            future.change_count = job.change_count
+            then(future, guarded(received), failed)
+        def received(response):
+            response = job.unwrap(response)
+            if job.is_stale(response) and not job.retried:
+                job.retried = True
+                return upload(job.chunks()) if large else send(job.full_request())
+            job.finish(response, save_on_format=save_on_format)
+            done()
+        if large and "contents" in job.sync:
+            upload(job.chunks())
         else:
-            self.view.run_command("prettier_format", {
-                "formatted": stdout,
-                "save_on_format": save_on_format
-            })
+            send(job.request())
 
-    def _too_large(self):
-        settings = load_settings()
-        max_size = settings.get('max_size') or 10240
-        if max_size < 0: max_size = 10240
-        return self.view.size() >= max_size
+
+class PrettierFormatAll(sublime_plugin.WindowCommand):
+    def run(self):
+        if not client.ready: return
+        sublime.set_timeout_async(self._format_all)
+
+    def _format_all(self):
+        jobs = []
+        for view in self.window.views():
+            if view.is_loading(): continue
+            # uploaded in chunks and given more time on their own, see PrettierFormat._run
+            if too_large(view):
+                view.run_command("prettier_format")
+            elif params := format_params(view):
+                jobs.append(FormatJob(view, params))
+        if not jobs: return
+        def failed():
+            for job in jobs:
+                job.document.reset()
+        def done(response):
+            results = response.get("ok") or [response] * len(jobs)
+            if stale := [i for i, job in enumerate(jobs) if job.is_stale(results[i])]:
+                def retried(response):
+                    for i, result in zip(stale, response.get("ok") or [response] * len(stale)):
+                        results[i] = result
+                    finish(results)
+                then(client.request("formatMany", { "items": [jobs[i].full_request() for i in stale] }), retried, failed)
+            else:
+                finish(results)
+        def finish(results):
+            for job, result in zip(jobs, results):
+                job.finish(result)
+        then(client.request("formatMany", { "items": [job.request() for job in jobs] }), done, failed)
 
 
 class PrettierSaveWithoutFormat(sublime_plugin.TextCommand):
@@ -312,46 +660,97 @@ class PrettierSaveWithoutFormat(sublime_plugin.TextCommand):
 
 class PrettierClearCache(sublime_plugin.ApplicationCommand):
     def run(self):
-        if not ready: return
+        if not client.ready: return
         call("clearConfigCache")
+        verified.clear()
         clear_status()
         status_error('Prettier: cleared cache.')
 
 
+class PrettierCacheStats(sublime_plugin.ApplicationCommand):
+    def run(self):
+        if not client.ready: return
+        then(client.request("cacheStats"), self._show)
+
+    def _show(self, response):
+        if "ok" not in response: return
+        stats = response["ok"]
+        print("prettierd: cache", stats)
+        status_error('Prettier: cache {hits} hits, {misses} misses, {entries} entries, {bytes} bytes.'.format(**stats))
+
+
 class PrettierRestart(sublime_plugin.ApplicationCommand):
     def run(self):
-        if not ready: return
-        sublime.set_timeout_async(regenerate)
+        if not client.ready: return
+        sublime.set_timeout_async(lambda: regenerate(restart=True))
         status_error('Prettier: restarting...')
 
 
+class PrettierDocumentListener(sublime_plugin.TextChangeListener):
+    @classmethod
+    def is_applicable(cls, buffer):
+        return True
+
+    def on_text_changed(self, changes):
+        buffer_id = self.buffer.id()
+        edits = [[c.a.pt, c.b.pt - c.a.pt, c.str] for c in changes]
+        dirty.setdefault(buffer_id, DirtyRanges()).record(edits)
+        document = documents.get(buffer_id)
+        if document is None: return
+        document.record(edits, self.buffer.primary_view().change_count())
+
+
 class PrettierListener(sublime_plugin.EventListener):
     def on_exit(self):
         quit_away()
+        if standby: quit_standby(standby)
+
+    def on_close(self, view):
+        buffer_id = view.buffer_id()
+        if view.clones(): return
+        dirty.pop(buffer_id, None)
+        computed.pop(buffer_id, None)
+        if buffer_id not in documents: return
+        del documents[buffer_id]
+        verified.pop(buffer_id, None)
+        formatting.pop(buffer_id, None)
+        scheduler.forget(buffer_id)
+        if client.ready: sublime.set_timeout_async(lambda: close_document(buffer_id))
 
     def on_pre_save(self, view):
         settings = load_settings()
-        if not ready or save_without_format: return
+        if not client.ready or save_without_format: return
         format_on_save = settings.get('format_on_save')
         if not format_on_save: return
         if format_on_save == "explicit":
             if not self._has_prettierrc(view.file_name()):
                 return
+        # nothing changed since the last format, no need to ask the daemon again
+        if is_verified(view): return
         save_on_format = settings.get('save_on_format')
         max_size = settings.get('max_size') or 10240
         if max_size < 0 or view.size() < max_size:
             view.run_command('prettier_format', { 'save_on_format': save_on_format })
+        # too large to format as a whole, only format where it was edited since the last save
+        elif settings.get('range_format_on_save', True) and (ranges := dirty.get(view.buffer_id())) and ranges.ranges:
+            view.run_command('prettier_format', {
+                'save_on_format': save_on_format,
+                'ranges': ranges.ranges,
+                'change_count': view.change_count()
+            })
 
     def on_post_save(self, view):
-        if not ready: return
+        dirty.pop(view.buffer_id(), None)
+        if not client.ready: return
         filename = view.file_name()
         if not filename: return
         filename = os.path.basename(filename)
         if filename == 'package.json' or 'prettierrc' in filename:
+            verified.clear()
             call("clearConfigCache")
 
     def on_activated(self, view):
-        if not ready: return
+        if not client.ready: return
         sublime.set_timeout_async(lambda: check_formattable(view))
 
     def _has_prettierrc(self, p):
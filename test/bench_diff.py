@@ -0,0 +1,89 @@
+# Compare diff_match_patch.diff_main with lib/linediff.py on before/after pairs of formatting,
+# and the edits through patch_make with the ones from a linediff.Diff, in time and memory.
+#
+#   python test/bench_diff.py
+#
+import os, sys, random, time, re, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
+import linediff
+from diff_match_patch import diff_match_patch
+from test_linediff import ROOT, unformat
+
+
+# minify(source) => the source in one line without indentation
+def minify(source):
+    return re.sub(r"\n\s*", " ", source)
+
+
+def measure(fn, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+# peak(fn) => the peak memory in bytes allocated while running fn()
+def peak(fn):
+    tracemalloc.start()
+    fn()
+    _, size = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+
+def changed(diffs):
+    return sum(len(text) for op, text in diffs if op != 0)
+
+
+# patch_edits(before, after) => the mutations applying patch_make(before, after) takes
+def patch_edits(dmp, before, after):
+    edits = []
+    for patch in dmp.patch_make(before, after):
+        point = patch.start1
+        for op, text in patch.diffs:
+            if op == 0:
+                point += len(text)
+            elif op == 1:
+                edits.append((point, 0, text))
+                point += len(text)
+            else:
+                edits.append((point, len(text), ""))
+    return edits
+
+
+def main():
+    rng = random.Random(0)
+    with open(os.path.join(ROOT, "prettierd.mjs"), encoding="utf-8") as f:
+        source = f.read()
+    pairs = [
+        ("one edit", source.replace("MAX_DOCUMENTS = 100", "MAX_DOCUMENTS  =  100"), source),
+        ("noisy", unformat(rng, source), source),
+        ("noisy x10", unformat(rng, source * 10), source * 10),
+        ("noisy x50", unformat(rng, source * 50), source * 50),
+        ("minified", minify(source), source),
+    ]
+    dmp = diff_match_patch()
+    print(f"{'pair':>10} {'size':>8} {'dmp':>10} {'linediff':>10} {'speedup':>8} {'changed (dmp / linediff)':>26}")
+    for name, before, after in pairs:
+        rounds = 1 if len(after) > (1 << 20) else 3
+        old, old_diffs = measure(lambda: dmp.diff_main(before, after), rounds)
+        new, new_diffs = measure(lambda: linediff.diff(before, after), rounds)
+        assert "".join(text for op, text in new_diffs if op >= 0) == after
+        print(f"{name:>10} {len(after) >> 10:>6}KB {old * 1000:>8.1f}ms {new * 1000:>8.1f}ms {old / new:>7.1f}x"
+              f" {changed(old_diffs):>13} / {changed(new_diffs)}")
+    print()
+    print(f"{'pair':>10} {'patch_make':>12} {'Diff':>10} {'memory':>19} {'mutations':>15}")
+    for name, before, after in pairs:
+        if len(after) > (1 << 20): continue
+        patches = lambda: patch_edits(dmp, before, linediff.diff(before, after))
+        compact = lambda: list(reversed(linediff.compact(before, after)))
+        old, old_edits = measure(patches, 1)
+        new, new_edits = measure(compact, 3)
+        print(f"{name:>10} {old * 1000:>10.1f}ms {new * 1000:>8.1f}ms"
+              f" {peak(patches) >> 10:>7}KB / {peak(compact) >> 10}KB {len(old_edits):>7} / {len(new_edits)}")
+
+
+main()
@@ -0,0 +1,59 @@
+# Compare the old receive loop (512-byte recv, bytes +=) with client.FrameProtocol.
+#
+#   python test/bench_recv.py
+#
+import os, sys, socket, threading, time, json, asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from lib.client import FrameProtocol
+from lib.rpc import HEADER, encode_frame
+
+
+def read_frame_old(sock):
+    size, = HEADER.unpack(sock.recv(HEADER.size, socket.MSG_WAITALL))
+    data = b""
+    while len(data) < size:
+        data += sock.recv(512)
+    return json.loads(data.decode("utf-8"))
+
+
+loop = asyncio.new_event_loop()
+
+
+def read_frame_protocol(sock):
+    async def read():
+        transport, protocol = await loop.create_connection(FrameProtocol, sock=sock)
+        future = protocol.pending[1] = loop.create_future()
+        try:
+            return await future
+        finally:
+            transport.close()
+    return loop.run_until_complete(read())
+
+
+def measure(read, frame, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        a, b = socket.socketpair()
+        sender = threading.Thread(target=a.sendall, args=(frame,))
+        start = time.perf_counter()
+        sender.start()
+        read(b)
+        best = min(best, time.perf_counter() - start)
+        sender.join()
+        a.close()
+        b.close()
+    return best
+
+
+def main():
+    line = "const answer = { value: 42, label: 'the answer' }\n"
+    print(f"{'size':>8} {'old':>10} {'new':>10} {'speedup':>8}")
+    for size in (10 << 10, 100 << 10, 1 << 20, 10 << 20):
+        frame = encode_frame({"id": 1, "ok": {"formatted": line * (size // len(line))}})
+        old = measure(read_frame_old, frame, 1 if size > (1 << 20) else 5)
+        new = measure(read_frame_protocol, frame, 5)
+        print(f"{size >> 10:>6}KB {old * 1000:>8.2f}ms {new * 1000:>8.2f}ms {old / new:>7.1f}x")
+
+
+main()
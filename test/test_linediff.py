@@ -0,0 +1,134 @@
+# Checks lib/linediff.py against diff_match_patch.
+#
+#   python -m unittest discover test
+#
+import os, sys, random, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
+import linediff
+from diff_match_patch import diff_match_patch
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+PIECES = ["x\n", "y\n", "z = 1\n", "a", "b", "\n", "  q\n", "\t", "😀", "\r\n"]
+
+
+def mutate(rng, text):
+    chars = list(text)
+    for _ in range(rng.randint(0, 8)):
+        p = rng.randint(0, len(chars))
+        if rng.random() < 0.5:
+            del chars[p:p + rng.randint(0, 6)]
+        else:
+            chars[p:p] = list(rng.choice(PIECES + ["  ", "\n\n", "yy z"]))
+    return "".join(chars)
+
+
+# unformat(source) => the source with the kind of noise prettier removes
+def unformat(rng, source):
+    lines = []
+    for line in source.splitlines(True):
+        if rng.random() < 0.2: line = line.lstrip(" ")
+        if rng.random() < 0.2: line = line.replace("'", '"')
+        if rng.random() < 0.1: line = line.replace("\n", "   \n")
+        if rng.random() < 0.1 and lines: line = lines.pop().rstrip("\n") + " " + line
+        lines.append(line)
+    return "".join(lines)
+
+
+class TestLineDiff(unittest.TestCase):
+    dmp = diff_match_patch()
+
+    def check(self, text1, text2):
+        diffs = linediff.diff(text1, text2)
+        self.assertEqual("".join(text for op, text in diffs if op <= 0), text1)
+        self.assertEqual("".join(text for op, text in diffs if op >= 0), text2)
+        for (op, text), (next_op, _) in zip(diffs, diffs[1:]):
+            self.assertTrue(text)
+            self.assertNotEqual(op, next_op)
+        # the same patches as diff_match_patch would apply
+        patched, applied = self.dmp.patch_apply(self.dmp.patch_make(text1, diffs), text1)
+        self.assertEqual(patched, text2)
+        self.assertTrue(all(applied))
+        expected, _ = self.dmp.patch_apply(self.dmp.patch_make(text1, text2), text1)
+        self.assertEqual(patched, expected)
+        # the edits applied in reverse give the same text, in as many mutations as the patches at most
+        compact = linediff.compact(text1, text2)
+        edits = list(compact)
+        self.assertEqual([list(edit) for edit in reversed(edits)], list(reversed(compact)))
+        self.assertEqual(bool(compact), bool(edits))
+        text = text1
+        for offset, length, insert in reversed(compact):
+            text = text[:offset] + insert + text[offset + length:]
+        self.assertEqual(text, text2)
+        self.assertLessEqual(len(edits), sum(op != 0 for patch in self.dmp.patch_make(text1, diffs) for op, _ in patch.diffs))
+        return diffs
+
+    def test_examples(self):
+        self.assertEqual(linediff.diff("", ""), [])
+        self.assertEqual(linediff.diff("a", "a"), [(0, "a")])
+        self.assertEqual(linediff.diff("", "a"), [(1, "a")])
+        self.assertEqual(linediff.diff("a", ""), [(-1, "a")])
+        self.assertEqual(linediff.diff("a  = 1\nb = 2\n", "a = 1\nb = 2\n"), [(0, "a "), (-1, " "), (0, "= 1\nb = 2\n")])
+        self.assertEqual(linediff.diff("a = 1", "a = 2"), [(0, "a = "), (-1, "1"), (1, "2")])
+        self.assertEqual(list(linediff.compact("a  = 1", "a = 1")), [[2, 1, ""]])
+        self.assertEqual(list(linediff.compact("a  = 1", "a = 2")), [[2, 1, ""], [5, 1, "2"]])
+        self.assertEqual(list(linediff.compact("ab", "xa")), [[0, 0, "x"], [1, 1, ""]])
+
+    def test_myers_is_shortest(self):
+        rng = random.Random(1)
+        for _ in range(300):
+            a = "".join(rng.choice("abc") for _ in range(rng.randint(0, 12)))
+            b = "".join(rng.choice("abc") for _ in range(rng.randint(0, 12)))
+            common = sum(n for _, _, n in linediff.myers(a, b, 100))
+            diffs = self.dmp.diff_main(a, b, False)
+            self.assertEqual(common, sum(len(text) for op, text in diffs if op == 0))
+
+    def test_random(self):
+        rng = random.Random(2)
+        for _ in range(2000):
+            text1 = "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 40)))
+            self.check(text1, mutate(rng, text1))
+
+    def test_unrelated(self):
+        rng = random.Random(3)
+        for _ in range(500):
+            text1 = "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 40)))
+            text2 = "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 40)))
+            self.check(text1, text2)
+
+    def test_over_budget(self):
+        # force the patience split, the steps and the whole-hunk replacements
+        rng = random.Random(4)
+        budget = linediff.MAX_LINE_EDITS, linediff.MAX_CHAR_EDITS, linediff.STEP_EDITS
+        linediff.MAX_LINE_EDITS, linediff.MAX_CHAR_EDITS, linediff.STEP_EDITS = 2, 2, 1
+        try:
+            for _ in range(1000):
+                text1 = "".join(rng.choice(PIECES + [f"{i}\n" for i in range(5)]) for _ in range(rng.randint(0, 40)))
+                self.check(text1, mutate(rng, mutate(rng, text1)))
+                self.check(text1 * 3, mutate(rng, text1) * 2)
+        finally:
+            linediff.MAX_LINE_EDITS, linediff.MAX_CHAR_EDITS, linediff.STEP_EDITS = budget
+
+    def test_steps(self):
+        rng = random.Random(6)
+        for _ in range(300):
+            a = [rng.randint(0, 3) for _ in range(rng.randint(0, 30))]
+            b = [rng.randint(0, 3) for _ in range(rng.randint(0, 30))]
+            i = j = 0
+            for x, y, n in linediff.steps(a, b):
+                self.assertTrue(x >= i and y >= j and n > 0)
+                self.assertEqual(a[x:x + n], b[y:y + n])
+                i, j = x + n, y + n
+
+    def test_sources(self):
+        rng = random.Random(5)
+        for name in ("prettierd.mjs", "prettierd.py"):
+            with open(os.path.join(ROOT, name), encoding="utf-8") as f:
+                source = f.read()
+            diffs = self.check(unformat(rng, source), source)
+            changed = sum(len(text) for op, text in diffs if op != 0)
+            self.assertLess(changed, len(source) // 5)
+
+
+if __name__ == "__main__":
+    unittest.main()